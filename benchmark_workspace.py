@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+"""Measures how the workspace commands scale, using FakeDesktop.
+
+Every command that workspace runs is answered by a FakeDesktop, which charges
+it a simulated cost: a fixed cost for starting the process plus a cost for every
+line of output. The results are printed as a tab separated table (or JSON
+lines) that can be compared across releases.
+
+Examples:
+  benchmark_workspace.py
+  benchmark_workspace.py --workspaces 4 50 --windows 0 1000 --ops move swap
+  benchmark_workspace.py --sleep --json > bench_output.txt
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import time
+from unittest.mock import patch
+
+import fake_desktop
+import workspace
+
+default_workspaces = [4, 16, 50, 200]
+default_windows = [0, 100, 1000, 10000]
+
+
+def make_desktop(num_workspaces, num_windows, **cost_args):
+    """Returns a FakeDesktop with the windows spread over every workspace but
+    the first, which is left empty so it can be deleted."""
+    f = fake_desktop.FakeDesktop(**cost_args)
+    f.SetWorkspaces([f"workspace {i}" for i in range(num_workspaces)])
+    f.Switch(num_workspaces // 2)
+    for i in range(num_windows):
+        f.OpenWindow(1 + i % (num_workspaces - 1), f"window {i}")
+    return f
+
+
+def operations(num_workspaces):
+    """Returns a map from operation name to a function that runs it."""
+    last = num_workspaces - 1
+    return {
+        "insert_before": lambda: workspace.insert_before(0),
+        "delete": lambda: workspace.delete(0),
+        "swap": lambda: workspace.swap(0, last),
+        "move": lambda: workspace.move(0, num_workspaces),
+        "swapleft": workspace.swapleft,
+        "list_workspaces": workspace.list_workspaces,
+    }
+
+
+def run_benchmark(op, num_workspaces, num_windows, **cost_args):
+    """Runs op once on a fresh desktop and returns a row of measurements.
+
+    cost_args are passed on to FakeDesktop: spawn_cost, line_cost and sleep."""
+    f = make_desktop(num_workspaces, num_windows, **cost_args)
+    run = operations(num_workspaces)[op]
+    # FakeDesktop answers the marco names commands, whatever desktop this runs
+    # under.
+    with patch("workspace.run_command", f.run_command), patch(
+        "workspace.names_backend", "marco"
+    ):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            run()
+            wall_time = time.perf_counter() - start
+    return {
+        "op": op,
+        "workspaces": num_workspaces,
+        "windows": num_windows,
+        "wall_s": round(wall_time, 6),
+        "simulated_s": round(f.simulated_time, 6),
+        "commands": sum(f.command_counts.values()),
+        "bytes_parsed": f.output_bytes,
+        "counts": dict(sorted(f.command_counts.items())),
+    }
+
+
+def print_table(rows):
+    kinds = sorted(set(kind for row in rows for kind in row["counts"]))
+    columns = ["op", "workspaces", "windows", "wall_s", "simulated_s", "commands"]
+    columns.append("bytes_parsed")
+    print("\t".join(columns + kinds))
+    for row in rows:
+        values = [str(row[c]) for c in columns]
+        values += [str(row["counts"].get(kind, 0)) for kind in kinds]
+        print("\t".join(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--workspaces", type=int, nargs="+", default=default_workspaces)
+    parser.add_argument("--windows", type=int, nargs="+", default=default_windows)
+    parser.add_argument(
+        "--ops", nargs="+", choices=list(operations(2)), default=list(operations(2))
+    )
+    parser.add_argument(
+        "--spawn-ms", type=float, default=2.0, help="cost of starting a command"
+    )
+    parser.add_argument(
+        "--line-us", type=float, default=10.0, help="cost per line of output"
+    )
+    parser.add_argument(
+        "--sleep", action="store_true", help="really wait out the simulated costs"
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    args = parser.parse_args()
+
+    rows = []
+    for num_workspaces in args.workspaces:
+        for num_windows in args.windows:
+            for op in args.ops:
+                row = run_benchmark(
+                    op,
+                    num_workspaces,
+                    num_windows,
+                    spawn_cost=args.spawn_ms / 1000,
+                    line_cost=args.line_us / 1000000,
+                    sleep=args.sleep,
+                )
+                if args.json:
+                    print(json.dumps(row), flush=True)
+                rows.append(row)
+    if not args.json:
+        print_table(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,55 @@
+import threading
+import time
+
+import workspace
+
+
+def command_kind(argv):
+    """Groups commands by what they do, e.g. "wmctrl -l" or "gsettings"."""
+    if argv[0] == "wmctrl":
+        return " ".join(argv[:2])
+    return argv[0]
+
+
 class FakeDesktop:
-    def __init__(self):
+    """Simulates wmctrl, gsettings and dconf for a desktop held in memory.
+
+    Every command is logged with a simulated cost of spawn_cost seconds plus
+    line_cost seconds per line of output, so tests and benchmarks can see how
+    many commands an operation needs and how long they would take. If sleep is
+    true the cost is really waited out, outside of any lock, so concurrent
+    commands overlap the way real processes would."""
+
+    def __init__(self, spawn_cost=0.0, line_cost=0.0, sleep=False):
         # List of names
         self._workspaces = []
-        # map from id (like 0x03800def) to (workspace_idx, window_name)
+        # map from id (like 0x03800def) to [workspace_idx, window_name]. The
+        # WM_CLASS of each window is in _window_classes.
         self._windows = {}
+        self._window_classes = {}
+        # map from workspace_idx to the ids of the windows on it, in the order
+        # they were opened.
+        self._windows_on_workspace = {}
+        # map from id to its row in the wmctrl -l -p -G -x output, and the whole
+        # output once it has been put together. Moving a window only replaces
+        # its row.
+        self._window_rows = {}
+        self._window_listing = None
         self._curr_workspace_idx = 0
+        self.active_window = None
         self._next_window_id = 1
+        self.spawn_cost = spawn_cost
+        self.line_cost = line_cost
+        self.sleep = sleep
+        # Array of tuples(command kind, output bytes, seconds) for every
+        # command run.
+        self.log = []
+        # map from command kind to how many times it ran.
+        self.command_counts = {}
+        self.output_bytes = 0
+        self.simulated_time = 0.0
+        # Commands may arrive from several threads at once.
+        self._lock = threading.RLock()
         self.OpenWindow(-1, "Bottom Panel")
         # Key = (command, stdin). Value = response
         self._expected_commands = {}
@@ -18,33 +62,95 @@ class FakeDesktop:
         return f"{idx:<2} {curr} DG: 1920x1080  VP: N/A  WA: 0,0 1920x1052  {name}"
 
     def _WindowRow(self, win_id, workspace_idx, window_name):
-        return f"0x{win_id:08X} {workspace_idx:>2} FooHost {window_name}"
+        pid = 1000 + win_id
+        wm_class = self._window_classes[win_id]
+        return (
+            f"0x{win_id:08X} {workspace_idx:>2} {pid:<6} 0    0    800  600  "
+            f"{wm_class:<20} FooHost {window_name}"
+        )
 
     def _ListWins(self):
-        result = []
-        for win_id in self._windows:
-            result.append(
-                self._WindowRow(
-                    win_id, self._windows[win_id][0], self._windows[win_id][1]
-                )
-            )
-        return "\n".join(result)
+        return "\n".join(
+            f"0x{win_id:08X} {workspace_idx:>2} FooHost {name}"
+            for (win_id, (workspace_idx, name)) in self._windows.items()
+        )
+
+    def _ListWinsWithDetails(self):
+        if self._window_listing is None:
+            self._window_listing = "\n".join(self._window_rows.values())
+        return self._window_listing
 
     def _ListWorkspaces(self):
         return "\n".join(
             [self._WorkspaceRow(i, name) for (i, name) in enumerate(self._workspaces)]
         )
 
+    def _MoveWindow(self, win_id, new_workspace_idx):
+        window = self._windows[win_id]
+        del self._windows_on_workspace[window[0]][win_id]
+        window[0] = new_workspace_idx
+        self._windows_on_workspace.setdefault(new_workspace_idx, {})[win_id] = None
+        self._window_rows[win_id] = self._WindowRow(win_id, window[0], window[1])
+        self._window_listing = None
+
+    def _SetNumWorkspaces(self, new_num_workspaces):
+        num_workspaces = len(self._workspaces)
+        if new_num_workspaces > num_workspaces:
+            for i in range(num_workspaces, new_num_workspaces):
+                self._workspaces.append("")
+        if new_num_workspaces < num_workspaces:
+            self._workspaces = self._workspaces[0:new_num_workspaces]
+            # Like Marco, move the windows of the removed workspaces to the
+            # new last one.
+            for idx in range(new_num_workspaces, num_workspaces):
+                for win_id in list(self._windows_on_workspace.get(idx, {})):
+                    self._MoveWindow(win_id, new_num_workspaces - 1)
+        if self._curr_workspace_idx >= new_num_workspaces:
+            self._curr_workspace_idx = new_num_workspaces - 1
+
+    def _ActivateWindow(self, win_id):
+        workspace_idx = self._windows[win_id][0]
+        if workspace_idx >= 0:
+            self._curr_workspace_idx = workspace_idx
+        self.active_window = win_id
+
+    def _SetWorkspaceName(self, workspace_idx, new_name):
+        if len(self._workspaces) >= workspace_idx + 1:
+            self._workspaces[workspace_idx] = new_name
+
+    def _Log(self, kind, output):
+        """Records a command and returns its simulated cost in seconds."""
+        lines = output.count("\n") + (1 if output else 0)
+        cost = self.spawn_cost + self.line_cost * lines
+        with self._lock:
+            self.log.append((kind, len(output), cost))
+            self.command_counts[kind] = self.command_counts.get(kind, 0) + 1
+            self.output_bytes += len(output)
+            self.simulated_time += cost
+        return cost
+
     def Switch(self, new_workspace_idx):
         self._curr_workspace_idx = new_workspace_idx
 
     def SetWorkspaces(self, names):
-        self._workspaces = names
+        self._workspaces = list(names)
 
-    def OpenWindow(self, workspace_idx, name):
-        self._windows[self._next_window_id] = [workspace_idx, name]
+    def OpenWindow(self, workspace_idx, name, wm_class="fake.Fake"):
+        win_id = self._next_window_id
+        self._windows[win_id] = [workspace_idx, name]
+        self._window_classes[win_id] = wm_class
+        self._windows_on_workspace.setdefault(workspace_idx, {})[win_id] = None
+        self._window_rows[win_id] = self._WindowRow(win_id, workspace_idx, name)
+        self._window_listing = None
         self._next_window_id += 1
 
+    def CloseWindow(self, win_id):
+        workspace_idx = self._windows.pop(win_id)[0]
+        del self._window_classes[win_id]
+        del self._windows_on_workspace[workspace_idx][win_id]
+        del self._window_rows[win_id]
+        self._window_listing = None
+
     def GetCurrWorkspace(self):
         return self.GetWorkspace(self._curr_workspace_idx)
 
@@ -55,66 +161,157 @@ class FakeDesktop:
         return list(self._workspaces)
 
     def GetWindowsOnWorkspace(self, workspace_idx):
-        result = []
-        for win_id in self._windows:
-            if self._windows[win_id][0] == workspace_idx:
-                win_name = self._windows[win_id][1]
-                result.append(win_name)
-        return result
-
-    def expect_command(self, expected_command, expected_stdin, response):
-        self._expected_commands[(expected_command, expected_stdin)] = response
-
-    def run_command(self, command, stdin=""):
-        if command == "wmctrl -l":
+        return [
+            self._windows[win_id][1]
+            for win_id in self._windows_on_workspace.get(workspace_idx, {})
+        ]
+
+    def expect_command(self, expected_argv, expected_stdin, response):
+        self._expected_commands[(tuple(expected_argv), expected_stdin)] = response
+
+    def run_command(self, argv, stdin="", timeout=None):
+        with self._lock:
+            stdout = self._Respond(argv, stdin)
+        if stdout is None:
+            stderr = f"Unknown Command: {argv}"
+            self.unexpected_commands.append((argv, stdin))
+            print(f"Error: {stderr}")
+            return workspace.CommandResult(argv, 1, "", stderr)
+        cost = self._Log(command_kind(argv), stdout)
+        if self.sleep:
+            time.sleep(cost)
+        return workspace.CommandResult(argv, 0, stdout, "", cost)
+
+    def _Respond(self, argv, stdin):
+        """Returns the stdout of a known command or None."""
+        if argv == ["wmctrl", "-l"]:
             return self._ListWins()
-        if command == "wmctrl -d":
+        if argv == ["wmctrl", "-l", "-p", "-G", "-x"]:
+            return self._ListWinsWithDetails()
+        if argv == ["wmctrl", "-d"]:
             return self._ListWorkspaces()
-        if command.startswith("wmctrl -s "):
-            self._curr_workspace_idx = int(command[len("wmctrl -s ") :])
+        if argv[:2] == ["wmctrl", "-s"]:
+            self._curr_workspace_idx = int(argv[2])
             return ""
-        if command.startswith("gsettings set org.mate.Marco.workspace-names name-"):
-            workspace_idx = int(command.split(" ")[3][5:])
+        if argv[:3] == ["gsettings", "set", "org.mate.Marco.workspace-names"]:
             # Mate Marco uses 1-based indexes. Need to convert to 0-based.
-            workspace_idx -= 1
-            new_name = command.split(" ")[4]
-            # Need to strip the quotes off
-            new_name = new_name[1:-1]
-            if len(self._workspaces) >= workspace_idx + 1:
-                self._workspaces[workspace_idx] = new_name
+            workspace_idx = int(argv[3][len("name-") :]) - 1
+            self._SetWorkspaceName(workspace_idx, argv[4])
+            return ""
+        if argv == ["dconf", "load", "/org/mate/marco/workspace-names/"]:
+            for line in stdin.split("\n"):
+                if not line.startswith("name-"):
+                    continue
+                key, value = line.split("=", 1)
+                # Mate Marco uses 1-based indexes. Need to convert to 0-based.
+                workspace_idx = int(key[len("name-") :]) - 1
+                # Strip the quotes and undo the GVariant escapes.
+                new_name = value[1:-1].replace("\\'", "'").replace("\\\\", "\\")
+                self._SetWorkspaceName(workspace_idx, new_name)
             return ""
-        if command.startswith("wmctrl -n "):
-            new_num_workspaces = int(command.split(" ")[2])
-            num_workspaces = len(self._workspaces)
-            if new_num_workspaces > num_workspaces:
-                for i in range(num_workspaces, new_num_workspaces):
-                    self._workspaces.append("")
-            if new_num_workspaces < num_workspaces:
-                self._workspaces = self._workspaces[0:new_num_workspaces]
-            for win_id in self._windows:
-                if self._windows[win_id][0] >= new_num_workspaces:
-                    self._windows[win_id][0] = num_num_workspaces - 1
-            if self._curr_workspace_idx >= new_num_workspaces:
-                self._curr_workspace_idx = new_num_workspaces - 1
+        if argv[:2] == ["wmctrl", "-n"]:
+            self._SetNumWorkspaces(int(argv[2]))
             return ""
-        if command.startswith("wmctrl -i -r ") and " -t " in command:
+        if argv[:3] == ["wmctrl", "-i", "-r"] and argv[4:5] == ["-t"]:
             # TODO: We should handle more ways of naming windows.
-            win_id = int(command.split()[3], 16)
-            new_workspace_idx = int(command.split()[5])
-            self._windows[win_id][0] = new_workspace_idx
+            win_id = int(argv[3], 16)
+            self._MoveWindow(win_id, int(argv[5]))
+            return ""
+        if argv[:3] == ["wmctrl", "-i", "-a"]:
+            self._ActivateWindow(int(argv[3], 16))
             return ""
-        if (command, stdin) in self._expected_commands:
-            return self._expected_commands[(command, stdin)]
-        result = f"Error: Unknown Command: {command}"
-        self.unexpected_commands.append((command, stdin))
-        print(result)
-        return result
+        return self._expected_commands.get((tuple(argv), stdin))
+
+
+class FakeEwmhConnection:
+    """Stands in for workspace.EwmhConnection, answering from a FakeDesktop.
+
+    Each property read or client message is logged as its _NET name with no
+    spawn cost, the way the ewmh backend talks over one X connection."""
+
+    root = "root"
+
+    def __init__(self, desktop):
+        self.desktop = desktop
+
+    def get_cardinal(self, window, name, default=None):
+        self.desktop._Log(name, "")
+        if name == "_NET_NUMBER_OF_DESKTOPS":
+            return len(self.desktop.GetWorkspaces())
+        if name == "_NET_CURRENT_DESKTOP":
+            return self.desktop._curr_workspace_idx
+        return default
+
+    def get_window_desktops(self, win_ids):
+        desktops = []
+        for win_id in win_ids:
+            self.desktop._Log("_NET_WM_DESKTOP", "")
+            desktops.append(self.desktop._windows[win_id][0])
+        return desktops
+
+    def get_client_list(self):
+        self.desktop._Log("_NET_CLIENT_LIST", "")
+        return list(self.desktop._windows)
+
+    def get_desktop_names(self):
+        self.desktop._Log("_NET_DESKTOP_NAMES", "")
+        return self.desktop.GetWorkspaces()
+
+    def get_window_info(self, desktop):
+        window_info = []
+        for win_id in self.get_client_list():
+            win_desktop, win_name = self.desktop._windows[win_id]
+            self.desktop._Log("_NET_WM_DESKTOP", "")
+            if desktop != "none" and win_desktop != int(desktop):
+                continue
+            wm_class = self.desktop._window_classes[win_id]
+            window_info.append(
+                workspace.WindowInfo(
+                    win_id, win_desktop, win_name, 1000 + win_id, wm_class
+                )
+            )
+        return window_info
+
+    def get_desktop_info(self):
+        self.desktop._Log("_NET_NUMBER_OF_DESKTOPS", "")
+        self.desktop._Log("_NET_CURRENT_DESKTOP", "")
+        names = self.get_desktop_names()
+        curr = self.desktop._curr_workspace_idx
+        return {
+            "curr": curr,
+            "num": len(names),
+            "list": [
+                workspace.Desktop(i, name, i == curr) for (i, name) in enumerate(names)
+            ],
+        }
+
+    def move_window_to_desktop(self, win_id, desktop):
+        self.desktop._Log("_NET_WM_DESKTOP", "")
+        self.desktop._MoveWindow(win_id, int(desktop))
+
+    def activate_window(self, win_id):
+        self.desktop._Log("_NET_ACTIVE_WINDOW", "")
+        self.desktop._ActivateWindow(win_id)
+
+    def set_num_desktops(self, num):
+        self.desktop._Log("_NET_NUMBER_OF_DESKTOPS", "")
+        self.desktop._SetNumWorkspaces(int(num))
+
+    def set_desktop_names(self, names):
+        """Replaces every name with one property write."""
+        self.desktop._Log("_NET_DESKTOP_NAMES", "")
+        for workspace_idx, name in enumerate(names):
+            self.desktop._SetWorkspaceName(workspace_idx, name)
+
+    def switch(self, desktop):
+        self.desktop._Log("_NET_CURRENT_DESKTOP", "")
+        self.desktop._curr_workspace_idx = int(desktop)
 
 
 # f = FakeDesktop()
 # f.SetWorkspaces(["main", "health"])
 # f.Switch(1)
 # f.OpenWindow(1, "Register | hoopla - Chromium")
-# r = f.run_command("wmctrl -d")
-# r = f.run_command("wmctrl -l")
+# r = f.run_command(["wmctrl", "-d"])
+# r = f.run_command(["wmctrl", "-l"])
 # print(r)
@@ -2,24 +2,28 @@
 
 import unittest
 import workspace
-import time
 import fake_desktop
+import benchmark_workspace
 import io
+import json
+import os
+import tempfile
+import threading
 from unittest.mock import patch
 
-
-def ShortSleep():
-    # It seems some time required before renames are visible to wmctrl.
-    # TODO: Figure out a way around this.
-    time.sleep(0.1)  # sleep in seconds.
-
-
 # Real tests use the real desktop not the fake one. These tests attempt to
-# leave the final state of the desktop the same as before the test.
+# leave the final state of the desktop the same as before the test. Changes
+# take a moment to show up in wmctrl, so they wait for each one to be applied.
 run_real_tests = True
 
 
 class TestWorkspace(unittest.TestCase):
+    def setUp(self):
+        # Use the Marco names backend whatever desktop the tests run on.
+        names_backend = patch("workspace.names_backend", "marco")
+        names_backend.start()
+        self.addCleanup(names_backend.stop)
+
     def test_argv_or(self):
         # create a shortcut to the function under test
         f = workspace.argv_or_impl
@@ -39,7 +43,50 @@ class TestWorkspace(unittest.TestCase):
         self.assertEqual("default", f(["ws", "debug", "mv"], 2, "default"))
         self.assertEqual("none", f(["ws", "debug", "mv"], 2, "none"))
         workspace.debugging = False
-
+        # "ewmh" selects the X backend and is not an argument either.
+        self.assertEqual("1", f(["ws", "ewmh", "mv", "1", "2"], 2, "default"))
+        self.assertEqual("1", f(["ws", "debug", "ewmh", "mv", "1"], 2, "default"))
+        self.assertEqual("ewmh", workspace.backend)
+        workspace.debugging = False
+        workspace.backend = "wmctrl"
+
+    def test_run_command(self):
+        result = workspace.run_command(["cat"], "hello world")
+        self.assertTrue(result.ok)
+        self.assertEqual(result.stdout, "hello world")
+        self.assertGreaterEqual(result.elapsed, 0)
+        result = workspace.run_command(["sh", "-c", "echo oops >&2; exit 3"])
+        self.assertFalse(result.ok)
+        self.assertEqual(result.error_message(), "Error: code 3\noops\n")
+        result = workspace.run_command(["sleep", "5"], timeout=0.1)
+        self.assertIsNone(result.returncode)
+        self.assertTrue(result.error_message().startswith("Error: sleep timed out"))
+        result = workspace.run_command(["no-such-command-for-workspace-tests"])
+        self.assertEqual(result.returncode, 127)
+
+    def test_real_ewmh_backend_matches_wmctrl(self):
+        # Run against Xvfb with a window manager, e.g. DISPLAY=:99.
+        if not run_real_tests or workspace.import_xlib() is None:
+            return
+        if not os.environ.get("DISPLAY"):
+            return
+        desktop_info = workspace.get_desktop_info()
+        win_info = workspace.get_window_info("none")
+        workspace.backend = "ewmh"
+        try:
+            # The ewmh backend doesn't read the geometry.
+            self.assertEqual(
+                [d[:3] for d in desktop_info["list"]],
+                [d[:3] for d in workspace.get_desktop_info()["list"]],
+            )
+            self.assertCountEqual(
+                [w[:5] for w in win_info],
+                [w[:5] for w in workspace.get_window_info("none")],
+            )
+        finally:
+            workspace.backend = "wmctrl"
+
+    @patch("workspace.wait_applied", True)
     def test_real_insert_and_delete_should_move_current_workspace(self):
         if not run_real_tests:
             return
@@ -49,8 +96,6 @@ class TestWorkspace(unittest.TestCase):
 
         workspace.insert_before(curr)
 
-        ShortSleep()
-
         desktop_info2 = workspace.get_desktop_info()
         win_info2 = workspace.get_window_info("none")
 
@@ -68,11 +113,12 @@ class TestWorkspace(unittest.TestCase):
         self.assertEqual(desktop_info, desktop_info3)
         self.assertEqual(win_info, win_info3)
 
-        self.assertEqual(desktop_info2["list"][curr], (str(curr), "new-desktop"))
+        self.assertEqual(desktop_info2["list"][curr].name, "new-desktop")
 
         self.assertNotEqual(desktop_info, desktop_info2)
         self.assertNotEqual(win_info, win_info2)
 
+    @patch("workspace.wait_applied", True)
     def test_real_swap(self):
         if not run_real_tests:
             return
@@ -81,17 +127,15 @@ class TestWorkspace(unittest.TestCase):
         num = desktop_info["num"]
         workspace.insert_before(num)
         workspace.rename(num, "new-desktop-123")
-        ShortSleep()
         workspace.swap(0, num)
-        ShortSleep()
         desktop_info = workspace.get_desktop_info()
         self.assertEqual(desktop_info["list"][0][1], "new-desktop-123")
         workspace.swap(0, num)
-        ShortSleep()
         desktop_info = workspace.get_desktop_info()
         self.assertEqual(desktop_info["list"][num][1], "new-desktop-123")
         workspace.delete(num)
 
+    @patch("workspace.wait_applied", True)
     def test_real_swapleft(self):
         if not run_real_tests:
             return
@@ -100,10 +144,8 @@ class TestWorkspace(unittest.TestCase):
         num = desktop_info["num"]
         workspace.insert_before(num)
         workspace.rename(num, "new-desktop-B")
-        ShortSleep()
         workspace.insert_before(num)
         workspace.rename(num, "new-desktop-A")
-        ShortSleep()
         workspace.switch(num + 1)
         desktop_info = workspace.get_desktop_info()
         self.assertEqual(desktop_info["curr"], num + 1)
@@ -118,6 +160,7 @@ class TestWorkspace(unittest.TestCase):
         workspace.delete(num)
         workspace.switch(curr)
 
+    @patch("workspace.wait_applied", True)
     def test_real_swapright(self):
         if not run_real_tests:
             return
@@ -126,10 +169,8 @@ class TestWorkspace(unittest.TestCase):
         num = desktop_info["num"]
         workspace.insert_before(num)
         workspace.rename(num, "new-desktop-B")
-        ShortSleep()
         workspace.insert_before(num)
         workspace.rename(num, "new-desktop-A")
-        ShortSleep()
         workspace.switch(num)
         desktop_info = workspace.get_desktop_info()
         self.assertEqual(desktop_info["curr"], num)
@@ -144,6 +185,47 @@ class TestWorkspace(unittest.TestCase):
         workspace.delete(num)
         workspace.switch(curr)
 
+    @patch("workspace.run_command")
+    def test_wait_until_applied(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["main", "extra"])
+        listings = []
+
+        def fake_run(command, stdin=""):
+            # The window manager takes three listings to show the new name.
+            if command == ["wmctrl", "-d"]:
+                listings.append(command)
+                if len(listings) == 3:
+                    f.SetWorkspaces(["main", "renamed"])
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        self.assertTrue(workspace.wait_until_applied(names={1: "renamed"}, num=2))
+        self.assertEqual(3, len(listings))
+        self.assertFalse(workspace.wait_until_applied(num=3, timeout=0.05))
+
+    @patch("workspace.wait_applied", True)
+    @patch("workspace.run_command")
+    def test_wait_keyword_waits_for_rename(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["main", "extra"])
+        pending = []
+
+        def fake_run(command, stdin=""):
+            # Apply the rename one listing later than it was asked for.
+            if command == ["wmctrl", "-d"] and pending:
+                f.run_command(*pending.pop())
+            if command[0] == "gsettings":
+                pending.append((command, stdin))
+                return workspace.CommandResult(command, 0)
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.rename(1, "renamed")
+        self.assertEqual(f.GetWorkspaces(), ["main", "renamed"])
+
     @patch("workspace.run_command")
     def test_switch(self, fake_run_command):
         f = fake_desktop.FakeDesktop()
@@ -270,6 +352,39 @@ class TestWorkspace(unittest.TestCase):
         workspace.rename(2, "last")
         self.assertEqual(f.GetWorkspaces(), ["main", "middle", "last"])
 
+    @patch("workspace.run_command")
+    def test_rename_many_is_one_write(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["main", "extra", "cool"])
+        commands = []
+
+        def fake_run(command, stdin=""):
+            commands.append(command)
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.rename_many([(0, "it's"), (2, "back\\slash")])
+        self.assertEqual(f.GetWorkspaces(), ["it's", "extra", "back\\slash"])
+        self.assertEqual(1, len(commands))
+
+    @patch("workspace.run_command")
+    def test_insert_at_start_renames_in_one_write(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c", "d"])
+        commands = []
+
+        def fake_run(command, stdin=""):
+            commands.append(command)
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.insert_before(0)
+        self.assertEqual(f.GetWorkspaces(), ["new-desktop", "a", "b", "c", "d"])
+        renames = [c for c in commands if c[0] in ("gsettings", "dconf")]
+        self.assertEqual(1, len(renames))
+
     @patch("workspace.run_command")
     def test_insert_new_at_end(self, fake_run_command):
         f = fake_desktop.FakeDesktop()
@@ -535,6 +650,475 @@ class TestWorkspace(unittest.TestCase):
             ["Life Expectancy - Chromium", "Inbox - Chromium", "TuxRacer"],
         )
 
+    @patch("workspace.run_command")
+    def test_move_lists_windows_once(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c", "d"])
+        f.OpenWindow(0, "a1")
+        f.OpenWindow(1, "b1")
+        f.OpenWindow(3, "d1")
+        commands = []
+
+        def fake_run(command, stdin=""):
+            commands.append(command)
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.move(3, 0)
+
+        self.assertEqual(f.GetWorkspaces(), ["d", "a", "b", "c"])
+        self.assertCountEqual(f.GetWindowsOnWorkspace(0), ["d1"])
+        self.assertCountEqual(f.GetWindowsOnWorkspace(2), ["b1"])
+        self.assertEqual(1, commands.count(workspace.list_windows_argv))
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.window_hosts", return_value=["myhost", "N/A"])
+    def test_parse_window_list(self, mock_hosts, mock_stdout):
+        lines = [
+            "0x01e00024  0 2049   0    24   1920 1032 Navigator.Firefox     host "
+            + "Two  spaces  - Mozilla Firefox\n",
+            "0x03a00003 -1 0      0    0    1920 24   N/A                   host \n",
+            "0x04000007  1 4242   10   20   854  480  Minecraft 1.20.1      myhost "
+            + "Minecraft 1.20.1\n",
+            "0x05000001  2 garbled\n",
+            "not a window\n",
+        ]
+        self.assertEqual(
+            list(workspace.parse_window_list(lines)),
+            [
+                workspace.WindowInfo(
+                    0x01E00024,
+                    0,
+                    "Two  spaces  - Mozilla Firefox",
+                    2049,
+                    "Navigator.Firefox",
+                    0,
+                    24,
+                    1920,
+                    1032,
+                ),
+                workspace.WindowInfo(0x03A00003, -1, "", 0, "N/A", 0, 0, 1920, 24),
+                workspace.WindowInfo(
+                    0x04000007,
+                    1,
+                    "Minecraft 1.20.1",
+                    4242,
+                    "Minecraft 1.20.1",
+                    10,
+                    20,
+                    854,
+                    480,
+                ),
+                workspace.WindowInfo(0x05000001, 2, "garbled"),
+            ],
+        )
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "Error: Can't parse this line of the window list: not a window\n",
+        )
+
+    def test_parse_desktop_list(self):
+        lines = [
+            "0  - DG: 1920x1080  VP: 0,0  WA: 0,24 1920x1032  mail  and  chat",
+            "1  * DG: 1920x1080  VP: N/A  WA: N/A  ",
+        ]
+        self.assertEqual(
+            list(workspace.parse_desktop_list(lines)),
+            [
+                workspace.Desktop(
+                    0, "mail  and  chat", False, "1920x1080", "0,24 1920x1032"
+                ),
+                workspace.Desktop(1, "", True, "1920x1080", "N/A"),
+            ],
+        )
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_movewins_with_filters(self, fake_run_command, mock_stdout):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c", "d", "e", "f"])
+        f.OpenWindow(1, "JIRA-12 - Firefox", "Navigator.Firefox")
+        f.OpenWindow(3, "Review jira-7 - Firefox", "Navigator.Firefox")
+        f.OpenWindow(4, "Jira board - Firefox", "Navigator.Firefox")
+        f.OpenWindow(5, "Mail - Firefox", "Navigator.Firefox")
+        f.OpenWindow(5, "jira notes", "gedit.Gedit")
+        fake_run_command.side_effect = f.run_command
+
+        args = ["--class", "firefox", "--title", "~jira-?\\d"]
+        workspace.move_matching_windows(args + ["--from", "1,3-5", "--to", "0"])
+
+        self.assertEqual(
+            f.GetWindowsOnWorkspace(0), ["JIRA-12 - Firefox", "Review jira-7 - Firefox"]
+        )
+        self.assertEqual(f.GetWindowsOnWorkspace(4), ["Jira board - Firefox"])
+        self.assertEqual(
+            f.command_counts, {"wmctrl -d": 1, "wmctrl -l": 1, "wmctrl -i": 2}
+        )
+
+        workspace.move_matching_windows(["--pid", "1005", "--to", "2"])
+        self.assertEqual(f.GetWindowsOnWorkspace(2), ["Mail - Firefox"])
+
+        workspace.move_matching_windows(["--class", "firefox"])
+        workspace.move_matching_windows(["--from", "2-x", "--to", "1"])
+        workspace.move_matching_windows(["--to", "6"])
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "Error: Please give the desktop to move to with --to\n"
+            "Error: Bad desktop range: 2-x\n"
+            "Error: Desktop number must range from 0 to 5\n",
+        )
+
+    def test_title_index(self):
+        index = workspace.TitleIndex(
+            [
+                workspace.WindowInfo(0x1, 0, "Inbox - Mail"),
+                workspace.WindowInfo(0x2, 1, "Mail"),
+                workspace.WindowInfo(0x3, 2, "Gmail - Chromium"),
+                workspace.WindowInfo(0x4, 2, "Mailing list archive - Chromium"),
+                workspace.WindowInfo(0x5, 3, "Terminal"),
+            ]
+        )
+        self.assertEqual([w.id for w in index.search("mail")], [0x2, 0x4, 0x1, 0x3])
+        self.assertEqual([w.id for w in index.search("CHROM gm")], [0x3])
+        self.assertEqual([w.id for w in index.search("te")], [0x5])
+        self.assertEqual(index.search("nothing"), [])
+
+    @patch("workspace.run_command")
+    def test_goto(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c"])
+        f.OpenWindow(0, "Terminal")
+        f.OpenWindow(2, "Inbox - Chromium")
+        fake_run_command.side_effect = f.run_command
+
+        workspace.goto("inbox")
+
+        self.assertEqual(f.GetCurrWorkspace(), "c")
+        self.assertEqual(f.active_window, 3)
+        self.assertEqual(f.command_counts, {"wmctrl -l": 1, "wmctrl -i": 1})
+
+    @patch("workspace.wait_applied", True)
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_missing_desktop_numbers(self, fake_run_command, mock_stdout):
+        workspace.switch("none")
+        workspace.switch("")
+        workspace.move_wins(1, "none")
+        workspace.move_wins("x", 2)
+        workspace.rename("none", "mail")
+
+        fake_run_command.assert_not_called()
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "Error: Please specify a desktop number\n" * 3
+            + "Error: Not a desktop number: x\n"
+            + "Error: Please specify a desktop number\n",
+        )
+
+    @patch("workspace.picker", "zenity")
+    @patch("workspace.run_command")
+    def test_zenity_with_nothing_selected(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b"])
+
+        def fake_run(command, stdin="", timeout=None):
+            if command[0] == "zenity":
+                return workspace.CommandResult(command, 0, "\n")
+            return f.run_command(command, stdin, timeout)
+
+        fake_run_command.side_effect = fake_run
+        workspace.gui_switch()
+
+        self.assertEqual(f.command_counts, {"wmctrl -d": 1})
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_goto_needs_a_query(self, fake_run_command, mock_stdout):
+        workspace.goto("")
+
+        fake_run_command.assert_not_called()
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "Error: Please give the text to search window titles for\n",
+        )
+
+    @patch("workspace.run_command")
+    def test_save_and_restore(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["mail", "code", "music"])
+        f.OpenWindow(0, "Inbox", "mail.Thunderbird")
+        f.OpenWindow(1, "Terminal", "term.Terminal")
+        f.OpenWindow(1, "Terminal", "term.Terminal")
+        f.OpenWindow(2, "Player", "player.Player")
+        fake_run_command.side_effect = f.run_command
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "layout.json")
+            workspace.save_layout(path)
+            with open(path) as saved:
+                layout = json.load(saved)
+            self.assertEqual(layout["desktops"], ["mail", "code", "music"])
+            self.assertIn(
+                {
+                    "id": "0x00000005",
+                    "desktop": 2,
+                    "class": "player.Player",
+                    "title": "Player",
+                },
+                layout["windows"],
+            )
+
+            # Mess things up, and let one window be reopened with a new ID.
+            f.run_command(["wmctrl", "-n", "4"])
+            f.run_command(["wmctrl", "-i", "-r", "0x00000003", "-t", "3"])
+            f.run_command(["wmctrl", "-i", "-r", "0x00000005", "-t", "0"])
+            f.run_command(
+                ["gsettings", "set", "org.mate.Marco.workspace-names"]
+                + ["name-1", "oops"]
+            )
+            f.CloseWindow(4)
+            f.OpenWindow(3, "Terminal", "term.Terminal")
+            f.command_counts.clear()
+
+            workspace.restore_layout(path)
+
+        self.assertEqual(f.GetWorkspaces(), ["mail", "code", "music"])
+        self.assertEqual(f.GetWindowsOnWorkspace(0), ["Inbox"])
+        self.assertEqual(f.GetWindowsOnWorkspace(1), ["Terminal", "Terminal"])
+        self.assertEqual(f.GetWindowsOnWorkspace(2), ["Player"])
+        self.assertEqual(
+            f.command_counts,
+            {
+                "wmctrl -l": 1,
+                "wmctrl -d": 1,
+                "wmctrl -i": 3,
+                "dconf": 1,
+                "wmctrl -n": 1,
+            },
+        )
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_restore_rejects_a_bad_layout(self, fake_run_command, mock_stdout):
+        window = {"id": "0x00000001", "desktop": 0, "class": "a.A", "title": "a"}
+        layouts = [
+            [],
+            {"windows": []},
+            {"desktops": [], "windows": []},
+            {"desktops": ["a", 2], "windows": []},
+            {"desktops": ["a"]},
+            {"desktops": ["a"], "windows": [dict(window, id="nope")]},
+            {"desktops": ["a"], "windows": [dict(window, desktop=-1)]},
+            {"desktops": ["a"], "windows": [{"id": "0x00000001"}]},
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "layout.json")
+            for layout in layouts:
+                with self.subTest(layout=layout):
+                    with open(path, "w") as f:
+                        json.dump(layout, f)
+                    mock_stdout.truncate(0)
+                    mock_stdout.seek(0)
+                    workspace.restore_layout(path)
+                    self.assertTrue(mock_stdout.getvalue().startswith("Error: "))
+        fake_run_command.assert_not_called()
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_save_and_restore_need_a_file(self, fake_run_command, mock_stdout):
+        workspace.save_layout("")
+        workspace.restore_layout("")
+
+        fake_run_command.assert_not_called()
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "Error: Please give the file to save the layout to\n"
+            "Error: Please give the file to restore the layout from\n",
+        )
+
+    def test_restore_without_a_current_desktop(self):
+        desktop_info = {
+            "curr": None,
+            "num": 3,
+            "list": [workspace.Desktop(i, name) for (i, name) in enumerate("abc")],
+        }
+        window_info = [workspace.WindowInfo(0x2, 2, "c1", 0, "c.C")]
+        model = workspace.LayoutModel(
+            desktop_info, workspace.index_windows(window_info)
+        )
+        layout = {"desktops": ["x", "y"], "windows": []}
+
+        workspace.restore_saved_layout(model, layout, window_info)
+
+        plan = model.plan()
+        self.assertEqual(plan["num"], 2)
+        self.assertEqual(plan["moves"], [(0x2, 1)])
+        self.assertEqual(plan["curr"], None)
+
+    @patch("workspace.run_command")
+    def test_compact(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c", "d", "e", "f"])
+        f.Switch(3)
+        f.OpenWindow(1, "b1")
+        f.OpenWindow(4, "e1")
+        f.OpenWindow(4, "e2")
+        fake_run_command.side_effect = f.run_command
+
+        workspace.compact()
+
+        self.assertEqual(f.GetWorkspaces(), ["b", "e"])
+        self.assertEqual(f.GetWindowsOnWorkspace(1), ["e1", "e2"])
+        self.assertEqual(f.GetWindowsOnWorkspace(-1), ["Bottom Panel"])
+        # The current workspace was removed, so land on its left neighbour.
+        self.assertEqual(f.GetCurrWorkspace(), "b")
+        self.assertEqual(
+            f.command_counts,
+            {
+                "wmctrl -d": 1,
+                "wmctrl -l": 1,
+                "wmctrl -i": 3,
+                "dconf": 1,
+                "wmctrl -n": 1,
+                "wmctrl -s": 1,
+            },
+        )
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_reorder_and_sort(self, fake_run_command, mock_stdout):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["mail", "code", "Music", "chat", "web"])
+        f.Switch(1)
+        f.OpenWindow(1, "c1")
+        f.OpenWindow(2, "m1")
+        f.OpenWindow(4, "w1")
+        f.OpenWindow(4, "w2")
+        fake_run_command.side_effect = f.run_command
+
+        workspace.reorder_desktops(["4", "0", "1", "2", "3"])
+
+        self.assertEqual(f.GetWorkspaces(), ["web", "mail", "code", "Music", "chat"])
+        self.assertEqual(f.GetCurrWorkspace(), "code")
+        self.assertEqual(f.GetWindowsOnWorkspace(0), ["w1", "w2"])
+        self.assertEqual(
+            f.command_counts,
+            {
+                "wmctrl -d": 1,
+                "wmctrl -l": 1,
+                "wmctrl -i": 4,
+                "dconf": 1,
+                "wmctrl -s": 1,
+            },
+        )
+
+        workspace.sort_desktops("name")
+        self.assertEqual(f.GetWorkspaces(), ["chat", "code", "mail", "Music", "web"])
+        self.assertEqual(f.GetCurrWorkspace(), "code")
+
+        workspace.sort_desktops("windows")
+        self.assertEqual(f.GetWorkspaces(), ["web", "code", "Music", "chat", "mail"])
+        self.assertEqual(f.GetWindowsOnWorkspace(2), ["m1"])
+        self.assertEqual(f.GetCurrWorkspace(), "code")
+
+        workspace.reorder_desktops(["0", "1", "1", "2", "3"])
+        workspace.sort_desktops("size")
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "Error: Please list every desktop from 0 to 4 once\n"
+            "Error: Can't sort by size. Use name or windows\n",
+        )
+
+    def test_layout_model_reorder(self):
+        desktop_info = {
+            "curr": 1,
+            "num": 3,
+            "list": [workspace.Desktop(i, name) for (i, name) in enumerate("abc")],
+        }
+        window_index = workspace.index_windows(
+            [
+                workspace.WindowInfo(0x1, -1, "panel"),
+                workspace.WindowInfo(0x2, 0, "a1"),
+                workspace.WindowInfo(0x3, 2, "c1"),
+                workspace.WindowInfo(0x4, 2, "c2"),
+            ]
+        )
+
+        def plan_reorder(order):
+            model = workspace.LayoutModel(desktop_info, window_index)
+            model.reorder(order)
+            return model.plan()
+
+        # move 2 to the front
+        plan = plan_reorder([2, 0, 1])
+        self.assertEqual(plan["num"], 3)
+        self.assertCountEqual(plan["moves"], [(0x2, 1), (0x3, 0), (0x4, 0)])
+        self.assertEqual(plan["renames"], [(0, "c"), (1, "a"), (2, "b")])
+        self.assertEqual(plan["curr"], 2)
+        # insert at the end only names the new desktop
+        plan = plan_reorder([0, 1, 2, None])
+        self.assertEqual(plan["num"], 4)
+        self.assertEqual(plan["moves"], [])
+        self.assertEqual(plan["renames"], [(3, "new-desktop")])
+        self.assertEqual(plan["curr"], None)
+        # deleting the current desktop lands on its left neighbour
+        plan = plan_reorder([0, 2])
+        self.assertCountEqual(plan["moves"], [(0x3, 1), (0x4, 1)])
+        self.assertEqual(plan["renames"], [(1, "c")])
+        self.assertEqual(plan["curr"], 0)
+
+    @patch("workspace.run_command")
+    def test_move_to_end_moves_each_window_once(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces([f"d{i}" for i in range(30)])
+        for i in range(30):
+            f.OpenWindow(i, f"w{i}")
+        commands = []
+
+        def fake_run(command, stdin=""):
+            commands.append(command)
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.move(0, 30)
+
+        self.assertEqual(f.GetWorkspaces(), [f"d{i}" for i in range(1, 30)] + ["d0"])
+        self.assertCountEqual(f.GetWindowsOnWorkspace(29), ["w0"])
+        moves = [c for c in commands if c[:3] == ["wmctrl", "-i", "-r"]]
+        self.assertEqual(30, len(moves))
+        self.assertFalse([c for c in commands if c[:2] == ["wmctrl", "-n"]])
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_movewins_reports_failures_together(self, fake_run_command, mock_stdout):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["main", "middle", "last"])
+        f.OpenWindow(1, "Terminal")
+        f.OpenWindow(1, "Gone")
+        f.OpenWindow(1, "Inbox - Chromium")
+
+        def fake_run(command, stdin=""):
+            if command[:4] == ["wmctrl", "-i", "-r", "0x00000003"]:
+                return workspace.CommandResult(
+                    command, 1, "", "Cannot find the window\n"
+                )
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.move_wins(1, 2)
+
+        self.assertCountEqual(
+            f.GetWindowsOnWorkspace(2), ["Terminal", "Inbox - Chromium"]
+        )
+        self.assertEqual(
+            "Error: 1 of 3 window moves failed\n"
+            "  0x00000003 -> 2: Error: code 1\nCannot find the window\n",
+            mock_stdout.getvalue(),
+        )
+
     @patch("workspace.run_command")
     def test_swap(self, fake_run_command):
         f = fake_desktop.FakeDesktop()
@@ -561,6 +1145,27 @@ class TestWorkspace(unittest.TestCase):
         )
         self.assertCountEqual(f.GetWindowsOnWorkspace(2), ["Terminal", "Select items"])
 
+    @patch("workspace.run_command")
+    def test_swap_moves_windows_directly(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["first", "middle", "last"])
+        f.OpenWindow(0, "Terminal")
+        f.OpenWindow(1, "Inbox - Chromium")
+        f.OpenWindow(2, "TuxRacer")
+        f.OpenWindow(2, "Sudoku")
+        fake_run_command.side_effect = f.run_command
+
+        workspace.swap(0, 2)
+
+        # One listing of each kind, one move per window on the two desktops,
+        # one rename and no temporary desktop.
+        self.assertEqual(
+            f.command_counts,
+            {"wmctrl -d": 1, "wmctrl -l": 1, "wmctrl -i": 3, "dconf": 1},
+        )
+        self.assertEqual(f.GetWorkspaces(), ["last", "middle", "first"])
+        self.assertEqual(f.GetWindowsOnWorkspace(1), ["Inbox - Chromium"])
+
     @patch("workspace.run_command")
     def test_swapleft(self, fake_run_command):
         f = fake_desktop.FakeDesktop()
@@ -682,6 +1287,606 @@ class TestWorkspace(unittest.TestCase):
         self.assertEqual(f.GetCurrWorkspace(), "b")
         self.assertCountEqual(f.GetWindowsOnWorkspace(4), ["b1", "b2"])
 
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_daemon_runs_forwarded_commands(self, fake_run_command, mock_stdout):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["main", "extra", "cool"])
+        f.OpenWindow(2, "Terminal")
+
+        def fake_run(command, stdin=""):
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        with tempfile.TemporaryDirectory() as runtime_dir:
+            with patch.dict(os.environ, {"XDG_RUNTIME_DIR": runtime_dir}):
+                server = workspace.open_daemon_socket(workspace.daemon_socket_path())
+                daemon = threading.Thread(
+                    target=workspace.serve_daemon, args=(server, 2)
+                )
+                daemon.start()
+                self.assertTrue(workspace.forward_to_daemon(["swap", "0", "2"]))
+                self.assertTrue(workspace.forward_to_daemon(["list"]))
+                daemon.join()
+                server.close()
+
+        self.assertEqual(f.GetWorkspaces(), ["cool", "extra", "main"])
+        self.assertIn(" 0  *  1  cool\n", mock_stdout.getvalue())
+
+    @patch("workspace.gui_switch")
+    @patch("workspace.forward_to_daemon", return_value=True)
+    def test_dialogs_are_not_forwarded(self, mock_forward, mock_gui_switch):
+        with tempfile.TemporaryDirectory() as runtime_dir:
+            with patch.dict(os.environ, {"XDG_RUNTIME_DIR": runtime_dir}):
+                with patch("sys.argv", ["workspace.py", "gui_switch"]):
+                    workspace.main()
+
+        mock_forward.assert_not_called()
+        mock_gui_switch.assert_called_once_with()
+
+    @patch("workspace.run_command")
+    def test_state_cache_keeps_listings_until_invalidated(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["main", "extra"])
+        f.OpenWindow(1, "Terminal")
+        commands = []
+
+        def fake_run(command, stdin=""):
+            commands.append(command)
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        with patch("workspace.state_cache", {}):
+            workspace.get_window_info("none")
+            workspace.get_window_info(1)
+            workspace.get_desktop_info()
+            workspace.get_desktop_info()
+            self.assertEqual(1, commands.count(workspace.list_windows_argv))
+            self.assertEqual(1, commands.count(["wmctrl", "-d"]))
+            workspace.invalidate_state_cache()
+            workspace.get_window_info("none")
+            self.assertEqual(2, commands.count(workspace.list_windows_argv))
+
+    @patch("workspace.state_cache", None)
+    @patch("workspace.fresh", False)
+    @patch("workspace.import_xlib", lambda: None)
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_state_file(self, fake_run_command, mock_stdout):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["main", "extra"])
+        f.OpenWindow(1, "Terminal")
+        fake_run_command.side_effect = f.run_command
+
+        def run(*argv):
+            with patch("sys.argv", ["workspace.py"] + list(argv)):
+                workspace.main()
+
+        with tempfile.TemporaryDirectory() as runtime_dir:
+            with patch.dict(os.environ, {"XDG_RUNTIME_DIR": runtime_dir}):
+                run("list")
+                run("list")
+                run("listwin")
+                self.assertEqual(f.command_counts, {"wmctrl -d": 1, "wmctrl -l": 1})
+                run("--fresh", "list")
+                self.assertEqual(f.command_counts, {"wmctrl -d": 2, "wmctrl -l": 2})
+                # As if each command were its own process.
+                workspace.fresh = False
+                # Our own changes are never answered from the file, and the
+                # listings right after them aren't saved.
+                run("rename", "1", "renamed")
+                run("list")
+                run("list")
+                self.assertEqual(f.command_counts["wmctrl -d"], 4)
+                with patch("workspace.state_file_settle", 0):
+                    run("list")
+                run("list")
+                self.assertEqual(f.command_counts["wmctrl -d"], 5)
+                with patch("workspace.state_file_ttl", 0):
+                    run("list")
+                self.assertEqual(f.command_counts["wmctrl -d"], 6)
+
+        self.assertTrue(mock_stdout.getvalue().endswith(" 1  -  1  renamed\n"))
+
+    @patch("workspace.state_cache", None)
+    @patch("workspace.state_file_settle", 0)
+    @patch("workspace.import_xlib", lambda: None)
+    def test_state_file_keeps_an_invalidation_made_while_listing(self):
+        with tempfile.TemporaryDirectory() as runtime_dir:
+            with patch.dict(os.environ, {"XDG_RUNTIME_DIR": runtime_dir}):
+                run = workspace.load_state_file()
+                workspace.state_cache["desktops"] = {"curr": 0, "num": 1, "list": []}
+                # Another command changes the desktops before we save.
+                workspace.invalidate_state_file()
+                workspace.save_state_file(run)
+                saved = workspace.read_state_file()
+
+        self.assertEqual(list(saved), ["invalidated"])
+
+    @patch("workspace.run_command")
+    def test_state_fingerprint_sees_window_moves(self, fake_run_command):
+        if workspace.import_xlib() is None:
+            self.skipTest("python-xlib is not installed")
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["main", "extra"])
+        f.OpenWindow(1, "Terminal")
+        fake_run_command.side_effect = f.run_command
+
+        with patch("workspace.ewmh_connection", fake_desktop.FakeEwmhConnection(f)):
+            with patch.dict(os.environ, {"DISPLAY": ":99"}):
+                before = workspace.state_fingerprint()
+                self.assertEqual(before, workspace.state_fingerprint())
+                workspace.move_wins(1, 0)
+                self.assertNotEqual(before, workspace.state_fingerprint())
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_queued_swaps_are_folded(self, fake_run_command, mock_stdout):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c", "d", "e", "f", "g"])
+        f.Switch(6)
+        f.OpenWindow(6, "g1")
+        fake_run_command.side_effect = f.run_command
+
+        with tempfile.TemporaryDirectory() as runtime_dir:
+            with patch.dict(os.environ, {"XDG_RUNTIME_DIR": runtime_dir}):
+                # Key repeat: other processes queued theirs but haven't got
+                # the lock yet.
+                entries = [workspace.queue_command(["swapleft"]) for i in range(4)]
+                workspace.run_queued(["swapleft"])
+                self.assertEqual(os.listdir(workspace.spool_path()), [])
+                self.assertEqual(f.command_counts["dconf"], 1)
+                self.assertEqual(f.command_counts["wmctrl -i"], 1)
+                self.assertEqual(f.GetWorkspaces(), ["a", "g", "b", "c", "d", "e", "f"])
+                self.assertEqual(f.GetCurrWorkspace(), "g")
+                self.assertEqual(f.GetWindowsOnWorkspace(1), ["g1"])
+
+                # Two more presses, the second one at the far left.
+                workspace.run_queued(["swapleft"])
+                workspace.run_queued(["swapleft"])
+                self.assertEqual(f.GetWorkspaces(), ["g", "a", "b", "c", "d", "e", "f"])
+
+        # The extra swap at the far left is skipped.
+        self.assertIn("Error: Already at the far left", mock_stdout.getvalue())
+        self.assertFalse(any(os.path.exists(e) for e in entries))
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_watch(self, fake_run_command, mock_stdout):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b"])
+        f.OpenWindow(1, "b1")
+        fake_run_command.side_effect = f.run_command
+
+        class FakeConnection:
+            def __init__(self, changes):
+                self.changes = changes
+
+            def next_change(self, timeout=None):
+                if timeout is not None:
+                    return False
+                self.changes.pop(0)()
+                return True
+
+        changes = [
+            # A sticky window doesn't change the list, so nothing is printed.
+            lambda: f.OpenWindow(-1, "clock"),
+            lambda: f.run_command(["wmctrl", "-s", "1"]),
+        ]
+        workspace.watch("none", FakeConnection(changes), max_updates=2)
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "  0  *  0  a\n  1  -  1  b\n\n  0  -  0  a\n  1  *  1  b\n\n",
+        )
+
+        mock_stdout.truncate(0)
+        mock_stdout.seek(0)
+        changes = [lambda: f.run_command(["wmctrl", "-n", "3"])]
+        workspace.watch("--json", FakeConnection(changes), max_updates=2)
+        lines = mock_stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(
+            json.loads(lines[1])[2],
+            {"num": 2, "name": "", "windows": 0, "current": False},
+        )
+
+        mock_stdout.truncate(0)
+        mock_stdout.seek(0)
+        fake_run_command.reset_mock()
+        workspace.watch("--jsno", FakeConnection([]), max_updates=1)
+        self.assertEqual(mock_stdout.getvalue(), "Error: Unknown option: --jsno\n")
+        fake_run_command.assert_not_called()
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.state_cache", {"desktop_info": "stale"})
+    def test_daemon_stops_caching_when_x_goes_away(self, mock_stdout):
+        with patch("workspace.EwmhConnection", side_effect=OSError("gone")):
+            workspace.watch_for_changes()
+
+        self.assertIsNone(workspace.state_cache)
+        self.assertIn("gone", mock_stdout.getvalue())
+
+    def test_daemon_reports_a_bad_cwd(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as gone:
+            pass
+        stdout = workspace.run_in_daemon(["list"], gone)
+        self.assertTrue(stdout.startswith(f"Error: Can't run in {gone}: "))
+        self.assertEqual(os.getcwd(), cwd)
+        with tempfile.TemporaryDirectory() as other:
+            workspace.run_in_daemon(["help"], other)
+        self.assertEqual(os.getcwd(), cwd)
+
+    def test_no_daemon_to_forward_to(self):
+        with tempfile.TemporaryDirectory() as runtime_dir:
+            with patch.dict(os.environ, {"XDG_RUNTIME_DIR": runtime_dir}):
+                self.assertFalse(workspace.forward_to_daemon(["list"]))
+
+    def test_fake_desktop_shrink_moves_windows_to_last_workspace(self):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c", "d"])
+        f.Switch(3)
+        f.OpenWindow(1, "b1")
+        f.OpenWindow(2, "c1")
+        f.OpenWindow(3, "d1")
+
+        f.run_command(["wmctrl", "-n", "2"])
+
+        self.assertEqual(f.GetWorkspaces(), ["a", "b"])
+        self.assertEqual(f.GetCurrWorkspace(), "b")
+        self.assertCountEqual(f.GetWindowsOnWorkspace(1), ["b1", "c1", "d1"])
+        self.assertIn(
+            "0x00000004  1 FooHost d1", f.run_command(["wmctrl", "-l"]).stdout
+        )
+        self.assertEqual(f.command_counts, {"wmctrl -n": 1, "wmctrl -l": 1})
+
+    def test_ewmh_backend_against_fake_desktop(self):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c"])
+        f.Switch(2)
+        f.OpenWindow(0, "a1")
+        f.OpenWindow(2, "c1")
+
+        with patch("workspace.backend", "ewmh"), patch(
+            "workspace.ewmh_connection", fake_desktop.FakeEwmhConnection(f)
+        ), patch("workspace.run_command") as fake_run_command:
+            fake_run_command.side_effect = f.run_command
+            workspace.move(2, 0)
+
+        self.assertEqual(f.GetWorkspaces(), ["c", "a", "b"])
+        self.assertEqual(f.GetCurrWorkspace(), "c")
+        self.assertCountEqual(f.GetWindowsOnWorkspace(0), ["c1"])
+        self.assertCountEqual(f.GetWindowsOnWorkspace(1), ["a1"])
+        # Only the names still go through a command.
+        self.assertEqual(f.command_counts["dconf"], 1)
+        self.assertNotIn("wmctrl -l", f.command_counts)
+
+    def test_detect_names_backend(self):
+        detect = workspace.detect_names_backend
+        self.assertEqual(detect({}), "marco")
+        self.assertEqual(detect({"XDG_CURRENT_DESKTOP": "MATE"}), "marco")
+        self.assertEqual(detect({"XDG_CURRENT_DESKTOP": "XFCE"}), "xfwm")
+        self.assertEqual(detect({"XDG_CURRENT_DESKTOP": "ubuntu:GNOME"}), "mutter")
+        self.assertEqual(detect({"XDG_CURRENT_DESKTOP": "LXQt"}), "ewmh")
+        environ = {"XDG_CURRENT_DESKTOP": "XFCE", "WORKSPACE_NAMES_BACKEND": "ewmh"}
+        self.assertEqual(detect(environ), "ewmh")
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    @patch("workspace.names_backend", "ewmh")
+    @patch("workspace.run_command")
+    def test_unusable_names_backend(self, fake_run_command, mock_stdout):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b"])
+        f.OpenWindow(1, "b1")
+        fake_run_command.side_effect = f.run_command
+
+        with patch("workspace.import_xlib", lambda: None), patch(
+            "workspace.ewmh_connection", None
+        ):
+            workspace.insert_before(0)
+            workspace.rename(0, "mail")
+
+        self.assertEqual(f.GetWorkspaces(), ["a", "b"])
+        self.assertEqual(f.GetWindowsOnWorkspace(1), ["b1"])
+        self.assertEqual(
+            mock_stdout.getvalue(),
+            "Error: Renaming workspaces on this desktop requires python-xlib\n" * 2,
+        )
+
+    @patch("workspace.names_backend", "xfwm")
+    @patch("workspace.run_command")
+    def test_xfwm_names_are_written_at_once(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b"])
+        f.OpenWindow(1, "b1")
+        commands = []
+
+        def fake_run(command, stdin=""):
+            commands.append(command)
+            if command[0] == "xfconf-query":
+                return workspace.CommandResult(command, 0)
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.insert_before(0)
+
+        self.assertEqual(
+            [c for c in commands if c[0] == "xfconf-query"],
+            [
+                [
+                    "xfconf-query",
+                    "-c",
+                    "xfwm4",
+                    "-p",
+                    "/general/workspace_names",
+                    "-n",
+                    "--force-array",
+                ]
+                + ["-t", "string", "-s", "new-desktop"]
+                + ["-t", "string", "-s", "a"]
+                + ["-t", "string", "-s", "b"]
+            ],
+        )
+
+    @patch("workspace.names_backend", "mutter")
+    @patch("workspace.run_command")
+    def test_mutter_rename(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "it's"])
+        commands = []
+
+        def fake_run(command, stdin=""):
+            commands.append(command)
+            if command[0] == "gsettings":
+                return workspace.CommandResult(command, 0)
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.rename(0, "mail")
+
+        self.assertEqual(
+            commands[-1],
+            [
+                "gsettings",
+                "set",
+                "org.gnome.desktop.wm.preferences",
+                "workspace-names",
+                "['mail', 'it\\'s']",
+            ],
+        )
+
+    @patch("workspace.names_backend", "ewmh")
+    def test_ewmh_names_are_written_at_once(self):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c"])
+        f.OpenWindow(2, "c1")
+
+        with patch("workspace.run_command") as fake_run_command:
+            with patch("workspace.ewmh_connection", fake_desktop.FakeEwmhConnection(f)):
+                fake_run_command.side_effect = f.run_command
+                workspace.move(2, 0)
+
+        self.assertEqual(f.GetWorkspaces(), ["c", "a", "b"])
+        self.assertEqual(f.command_counts["_NET_DESKTOP_NAMES"], 1)
+        self.assertNotIn("dconf", f.command_counts)
+
+    @patch("sys.stderr", new_callable=io.StringIO)
+    @patch("workspace.run_command")
+    def test_trace(self, fake_run_command, mock_stderr):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c"])
+        f.OpenWindow(2, "c1")
+        fake_run_command.side_effect = f.run_command
+        untraced_move = workspace.move
+
+        with tempfile.TemporaryDirectory() as trace_dir:
+            path = os.path.join(trace_dir, "trace.json")
+            with patch.dict(os.environ, {"WORKSPACE_TRACE": path}):
+                workspace.argv_or_impl(["ws", "trace", "move", "2", "0"], 1, "none")
+                workspace.move(2, 0)
+                workspace.finish_tracing()
+            with open(path) as trace_file:
+                spans = json.load(trace_file)["traceEvents"]
+
+        self.assertIs(workspace.move, untraced_move)
+        self.assertIsNone(workspace.trace_spans)
+        names = [span["name"] for span in spans]
+        for name in ["move", "change_layout", "apply_plan", "wmctrl -l", "dconf load"]:
+            self.assertIn(name, names)
+        listing = spans[names.index("wmctrl -l")]
+        self.assertEqual(listing["cat"], "command")
+        self.assertEqual(listing["args"]["argv"], workspace.list_windows_argv)
+        self.assertGreater(listing["args"]["output_bytes"], 0)
+        move = spans[names.index("move")]
+        self.assertLessEqual(move["ts"], listing["ts"])
+        self.assertIn(path, mock_stderr.getvalue())
+
+    def test_benchmark_counts_commands(self):
+        # The benchmark pins the names backend itself.
+        with patch("workspace.names_backend", "ewmh"):
+            row = benchmark_workspace.run_benchmark("move", 4, 30, spawn_cost=0.5)
+        self.assertEqual(row["counts"]["wmctrl -l"], 1)
+        # Every window is on a desktop that shifts.
+        self.assertEqual(row["counts"]["wmctrl -i"], 30)
+        self.assertEqual(row["commands"], sum(row["counts"].values()))
+        self.assertAlmostEqual(row["simulated_s"], row["commands"] * 0.5, places=1)
+        self.assertGreater(row["bytes_parsed"], 0)
+
+    def count_commands(self, operation, num_workspaces=12, num_windows=120):
+        """Runs operation against a FakeDesktop and returns a map from command
+        kind to how many times it ran, plus the number of windows on each
+        workspace beforehand."""
+        f = benchmark_workspace.make_desktop(num_workspaces, num_windows)
+        windows_on = [len(f.GetWindowsOnWorkspace(i)) for i in range(num_workspaces)]
+        commands = []
+
+        def fake_run(command, stdin="", timeout=None):
+            commands.append(command)
+            if command[0] == "zenity":
+                return workspace.CommandResult(command, 0, "3\n")
+            return f.run_command(command, stdin, timeout)
+
+        with patch("workspace.run_command", side_effect=fake_run):
+            with patch("sys.stdout", new_callable=io.StringIO):
+                operation()
+        counts = {}
+        for command in commands:
+            kind = fake_desktop.command_kind(command)
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts, windows_on
+
+    def assertCommandBounds(self, counts, bounds):
+        # Names may be written by dconf or by gsettings, but only once.
+        counts = dict(counts)
+        names = counts.pop("dconf", 0) + counts.pop("gsettings", 0)
+        counts = dict(counts, names=names)
+        for kind, count in counts.items():
+            self.assertLessEqual(count, bounds.get(kind, 0), kind)
+
+    @patch("workspace.picker", "zenity")
+    def test_commands_grow_with_the_size_of_the_change(self):
+        # make_desktop puts the windows on workspaces 1 to 11, leaves 0 empty
+        # and makes 6 the current one.
+        def moves_of(first, last):
+            return lambda windows_on: sum(windows_on[first : last + 1])
+
+        one_pass = {"wmctrl -l": 1, "wmctrl -d": 1}
+        # Only insert and delete change the number of workspaces, move_wins
+        # keeps the names, and switching is only needed when the current
+        # workspace moves.
+        resized = dict(one_pass, **{"wmctrl -n": 1, "names": 1, "wmctrl -s": 1})
+        renamed = dict(one_pass, names=1)
+        switched = dict(renamed, **{"wmctrl -s": 1})
+        cases = [
+            (
+                "insert_before",
+                lambda: workspace.insert_before(3),
+                resized,
+                moves_of(3, 11),
+            ),
+            ("delete", lambda: workspace.delete(0), resized, moves_of(1, 11)),
+            ("swap", lambda: workspace.swap(2, 5), renamed, lambda w: w[2] + w[5]),
+            ("swapleft", workspace.swapleft, switched, moves_of(5, 6)),
+            ("swapright", workspace.swapright, switched, moves_of(6, 7)),
+            ("move", lambda: workspace.move(2, 5), renamed, moves_of(2, 4)),
+            ("move_wins", lambda: workspace.move_wins(3, 4), one_pass, moves_of(3, 3)),
+        ]
+        for name, operation, op_bounds, max_moves in cases:
+            with self.subTest(name):
+                counts, windows_on = self.count_commands(operation)
+                bounds = dict(op_bounds, **{"wmctrl -i": max_moves(windows_on)})
+                self.assertCommandBounds(counts, bounds)
+                self.assertGreater(counts.get("wmctrl -i", 0), 0)
+
+        # The bounds hold as the desktop grows.
+        counts, windows_on = self.count_commands(
+            workspace.swapleft, num_workspaces=50, num_windows=2000
+        )
+        bounds = dict(switched, **{"wmctrl -i": windows_on[24] + windows_on[25]})
+        self.assertCommandBounds(counts, bounds)
+
+        counts, _ = self.count_commands(workspace.list_workspaces)
+        self.assertCommandBounds(counts, {"wmctrl -l": 1, "wmctrl -d": 1})
+
+        counts, _ = self.count_commands(workspace.gui_switch)
+        self.assertCommandBounds(counts, {"wmctrl -d": 1, "zenity": 1, "wmctrl -s": 1})
+        self.assertEqual(counts["wmctrl -s"], 1)
+
+        # The built-in picker, with the user choosing workspace 3 once the
+        # listing is in.
+        def tk_pick_workspace():
+            workspace.load_picker_data()
+            return 3
+
+        with patch("workspace.picker", "tk"), patch(
+            "workspace.tk_pick_workspace", tk_pick_workspace
+        ):
+            counts, _ = self.count_commands(workspace.gui_switch)
+        self.assertEqual(counts, {"wmctrl -d": 1, "wmctrl -l": 1, "wmctrl -s": 1})
+
+    def make_batch_desktop(self):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c", "d"])
+        f.Switch(1)
+        f.OpenWindow(0, "a1")
+        f.OpenWindow(1, "b1")
+        f.OpenWindow(1, "b2")
+        f.OpenWindow(3, "d1")
+        return f
+
+    def test_batch_matches_running_commands_one_at_a_time(self):
+        script = [
+            "# set up a session",
+            "insert 0",
+            "rename 0 'mail and chat'",
+            "movewins 2 0",
+            "swapright",
+            "move 4 1",
+            "insert",
+            "delete 3",
+            "switch 0",
+            # Two new desktops are told apart.
+            "insert 0",
+            "insert 0",
+            "switch 1",
+            "swapleft",
+        ]
+        one_at_a_time = self.make_batch_desktop()
+        with patch("workspace.run_command", one_at_a_time.run_command):
+            workspace.insert_before(0)
+            workspace.rename(0, "mail and chat")
+            workspace.move_wins(2, 0)
+            workspace.swapright()
+            workspace.move(4, 1)
+            workspace.insert_before("none")
+            workspace.delete(3)
+            workspace.switch(0)
+            workspace.insert_before(0)
+            workspace.insert_before(0)
+            workspace.switch(1)
+            workspace.swapleft()
+
+        batched = self.make_batch_desktop()
+        with tempfile.TemporaryDirectory() as script_dir:
+            path = os.path.join(script_dir, "session")
+            with open(path, "w") as script_file:
+                script_file.write("\n".join(script))
+            with patch("workspace.run_command", batched.run_command):
+                workspace.batch(path)
+
+        self.assertEqual(batched.GetWorkspaces(), one_at_a_time.GetWorkspaces())
+        self.assertEqual(batched.GetCurrWorkspace(), one_at_a_time.GetCurrWorkspace())
+        for i in range(len(batched.GetWorkspaces())):
+            self.assertCountEqual(
+                batched.GetWindowsOnWorkspace(i),
+                one_at_a_time.GetWindowsOnWorkspace(i),
+            )
+        self.assertEqual(batched.command_counts["wmctrl -l"], 1)
+        self.assertEqual(batched.command_counts["wmctrl -d"], 1)
+        self.assertLessEqual(batched.command_counts.get("wmctrl -n", 0), 1)
+        # Each window moves at most once.
+        self.assertLessEqual(batched.command_counts["wmctrl -i"], 4)
+
+    @patch("sys.stdout", new_callable=io.StringIO)
+    def test_batch_changes_nothing_if_an_operation_fails(self, mock_stdout):
+        f = self.make_batch_desktop()
+        script = "insert 0\ndelete 2\n"
+        with patch("workspace.run_command", f.run_command), patch(
+            "sys.stdin", io.StringIO(script)
+        ):
+            workspace.batch("none")
+
+        self.assertEqual(
+            "Error: line 2: delete 2: Close or move the windows first\n",
+            mock_stdout.getvalue(),
+        )
+        self.assertEqual(f.GetWorkspaces(), ["a", "b", "c", "d"])
+        self.assertNotIn("wmctrl -n", f.command_counts)
+
     @patch("workspace.run_command")
     def test_gui_rename(self, fake_run_command):
         f = fake_desktop.FakeDesktop()
@@ -689,12 +1894,17 @@ class TestWorkspace(unittest.TestCase):
         f.Switch(1)
         self.assertEqual(f.GetCurrWorkspace(), "b")
         f.expect_command(
-            "zenity --text='Rename Current Workspace' --entry --entry-text='b'",
+            [
+                "zenity",
+                "--text=Rename Current Workspace",
+                "--entry",
+                "--entry-text=b",
+            ],
             "",
             "new_name_123",
         )
 
-        def fake_run(command, stdin=""):
+        def fake_run(command, stdin="", timeout=None):
             return f.run_command(command, stdin)
 
         fake_run_command.side_effect = fake_run
@@ -703,6 +1913,68 @@ class TestWorkspace(unittest.TestCase):
 
         self.assertEqual(f.GetWorkspaces(), ["a", "new_name_123", "c"])
 
+    @patch("workspace.run_command")
+    def test_gui_rename_keeps_names_starting_with_error(self, fake_run_command):
+        f = fake_desktop.FakeDesktop()
+        f.SetWorkspaces(["a", "b", "c"])
+        f.expect_command(
+            [
+                "zenity",
+                "--text=Rename Current Workspace",
+                "--entry",
+                "--entry-text=a",
+            ],
+            "",
+            "Error log triage\n",
+        )
+
+        def fake_run(command, stdin="", timeout=None):
+            return f.run_command(command, stdin)
+
+        fake_run_command.side_effect = fake_run
+
+        workspace.gui_rename()
+
+        self.assertEqual(f.GetWorkspaces(), ["Error log triage", "b", "c"])
+
+    def test_filter_workspaces(self):
+        desktop_info = {
+            "curr": 1,
+            "num": 3,
+            "list": [
+                workspace.Desktop(0, "mail"),
+                workspace.Desktop(1, "code", True),
+                workspace.Desktop(2, "music"),
+            ],
+        }
+        window_index = workspace.index_windows(
+            [
+                workspace.WindowInfo(0x1, 1, "Terminal"),
+                workspace.WindowInfo(0x2, 1, "Inbox - Chromium"),
+                workspace.WindowInfo(0x3, 2, "Spotify"),
+            ]
+        )
+        f = workspace.filter_workspaces
+        self.assertEqual(
+            f("", desktop_info, window_index),
+            [(0, "       0  mail"), (1, ">>>>   1  code"), (2, "       2  music")],
+        )
+        # names match first, then window titles
+        self.assertEqual(
+            f("M", desktop_info, window_index),
+            [
+                (0, "       0  mail"),
+                (2, "       2  music"),
+                (1, ">>>>   1  code  (Terminal)"),
+            ],
+        )
+        self.assertEqual(
+            f("inbox chrom", desktop_info, window_index),
+            [(1, ">>>>   1  code  (Inbox - Chromium)")],
+        )
+        self.assertEqual(f("nothing", desktop_info, window_index), [])
+
+    @patch("workspace.picker", "zenity")
     @patch("workspace.run_command")
     def test_gui_switch(self, fake_run_command):
         f = fake_desktop.FakeDesktop()
@@ -710,12 +1982,21 @@ class TestWorkspace(unittest.TestCase):
         f.Switch(1)
         self.assertEqual(f.GetCurrWorkspace(), "b")
         f.expect_command(
-            "zenity --list --column=num --column=Curr --column='Desktop Name' --hide-column=1 --height=540 --width=300",
+            [
+                "zenity",
+                "--list",
+                "--column=num",
+                "--column=Curr",
+                "--column=Desktop Name",
+                "--hide-column=1",
+                "--height=540",
+                "--width=300",
+            ],
             "0\n.\na\n1\n>>>>\nb\n2\n.\nc\n",
             "2",
         )
 
-        def fake_run(command, stdin=""):
+        def fake_run(command, stdin="", timeout=None):
             return f.run_command(command, stdin)
 
         fake_run_command.side_effect = fake_run
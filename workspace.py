@@ -1,7 +1,44 @@
 #!/usr/bin/python3
 
+import collections
+import contextlib
+import fcntl
+import functools
+import io
+import json
+import os
+import re
+import select
+import shlex
+import signal
+import socket
 import sys
 import subprocess
+import threading
+import time
+import traceback
+
+# python-xlib, or None if it isn't installed. It is only imported by
+# import_xlib, the first time X is used, since importing it takes longer than
+# handing a command to the daemon.
+Xlib = None
+xlib_imported = False
+
+
+def import_xlib():
+    """Imports python-xlib if that hasn't been tried yet, and returns it, or
+    None if it isn't installed."""
+    global Xlib, xlib_imported
+    if not xlib_imported:
+        xlib_imported = True
+        try:
+            import Xlib.display
+            import Xlib.error
+            import Xlib.protocol.event
+            import Xlib.X
+        except ImportError:
+            Xlib = None
+    return Xlib
 
 
 def help():
@@ -11,8 +48,15 @@ Examples:
   -------------------------------------------------------------------------
   | workspace help               | Display this help.                     |
   | workspace list               | List all workspaces.                   |
+  | workspace watch              | List all workspaces, then again every  |
+  |                              | time they change. Add --json to print  |
+  |                              | one JSON line per change.              |
   | workspace listwin            | List all windows.                      |
   | workspace listwin 8          | List all windows in workspace 8.       |
+  | workspace find term          | List the windows whose titles contain  |
+  |                              | term, best match first.                |
+  | workspace goto term          | Switch to the best match for term and  |
+  |                              | activate the window.                   |
   | workspace switch 4           | Switch to workspace 4.                 |
   | workspace rename 3 "foo bar" | Rename workspace 3 to "foo bar".       |
   | workspace insert             | Insert a workspace before the current. |
@@ -20,7 +64,20 @@ Examples:
   | workspace delete             | Delete the current workspace.          |
   | workspace delete 3           | Delete workspace 3.                    |
   | workspace movewins 7 8       | Moves all windows from desktop 7 to 8. |
+  | workspace movewins --class   | Moves the Firefox windows whose titles |
+  |   firefox --title '~jira'    | match the regular expression jira from |
+  |   --from 3,5-7 --to 2        | desktops 3, 5, 6 and 7 to desktop 2.   |
+  |                              | --pid picks the windows of a process.  |
   | workspace debug command      | Print debugging while running command. |
+  | workspace ewmh command       | Talk to the window manager directly    |
+  |                              | over X instead of running wmctrl.      |
+  |                              | Requires python-xlib.                  |
+  | workspace wait command       | Return only once the window manager    |
+  |                              | shows the changes made by command.     |
+  | workspace --fresh command    | Read the desktops from X even if a     |
+  |                              | listing from the last 2s is saved.     |
+  | workspace trace command      | Record how long each step and external |
+  |                              | command takes, as a Chrome trace.      |
   | workspace swap 3 5           | Swap workspaces 3 and 5.               |
   | workspace swapleft           | Swap the current workspace to the left.|
   | workspace swapright          | Swap the curr workspace to the right.  |
@@ -29,13 +86,41 @@ Examples:
   |                              | workspace.                             |
   | workspace gui_switch         | Open a dialog box to list all the      |
   |                              | workspaces and allow the user to switch|
-  |                              | to another workspace.                  |
+  |                              | to another workspace. Type to filter   |
+  |                              | by workspace name or window title.     |
+  | workspace reorder 4 0 1 2 3  | Put workspace 4 first, then 0, 1, 2    |
+  |                              | and 3, in a single pass.               |
+  | workspace sort --by name     | Sort the workspaces by name, or with   |
+  |                              | --by windows, by number of windows.    |
+  | workspace compact            | Delete every workspace that has no     |
+  |                              | windows, in a single pass.             |
+  | workspace batch file         | Run the commands in file, one per line,|
+  |                              | with a single set of changes at the    |
+  |                              | end. Reads stdin if file is missing.   |
+  | workspace save file          | Save the workspace names and where     |
+  |                              | every window is to file.               |
+  | workspace restore file       | Put the workspaces and windows back as |
+  |                              | they were saved, in a single pass.     |
+  | workspace daemon             | Stay running and answer the other      |
+  |                              | commands over a Unix socket. Later     |
+  |                              | commands are forwarded to it.          |
   -------------------------------------------------------------------------
 """
     )
 
 
 debugging = False
+# "wmctrl" runs the wmctrl command for every query and window move. "ewmh"
+# reads and writes the EWMH root window properties over one X connection.
+backend = "wmctrl"
+
+# Set by the "wait" keyword. Commands that change the desktops block until
+# the window manager shows the changes, for up to wait_timeout seconds.
+wait_applied = False
+wait_timeout = 2.0
+
+# Keywords that may appear before the command to change how it runs.
+modifiers = ["debug", "ewmh", "wait", "trace", "--fresh"]
 
 
 def argv_or(n, default):
@@ -43,113 +128,1269 @@ def argv_or(n, default):
 
 
 def argv_or_impl(argv, n, default):
-    global debugging
-    if len(argv) < 2:
-        return default
-    if argv[1] == "debug":
-        debugging = True
-        n = n + 1
+    global debugging, backend, wait_applied, fresh
+    i = 1
+    while len(argv) > i and argv[i] in modifiers:
+        if argv[i] == "debug":
+            debugging = True
+        if argv[i] == "ewmh":
+            backend = "ewmh"
+        if argv[i] == "wait":
+            wait_applied = True
+        if argv[i] == "trace":
+            start_tracing()
+        if argv[i] == "--fresh":
+            fresh = True
+        i += 1
+    n = n + i - 1
     if len(argv) > n:
         return argv[n]
     return default
 
 
+def argv_from(n):
+    """Returns the arguments from the nth on."""
+    args = []
+    while argv_or(n + len(args), None) is not None:
+        args.append(argv_or(n + len(args), None))
+    return args
+
+
 def debug(msg):
     if debugging:
         print(f"debug: {msg}")
 
 
-def run_command(command, stdin=""):
-    result = subprocess.run(
-        command, input=stdin, capture_output=True, shell=True, text=True
-    )
-    if result.returncode == 0:
-        return result.stdout
-    else:
-        return f"Error: code {result.returncode}\n{result.stderr}"
+# Spans recorded since the "trace" keyword turned tracing on, or None.
+trace_spans = None
+# The functions that get a span for every call while tracing. They are only
+# wrapped while tracing is on, so tracing costs nothing when it is off.
+traced_functions = [
+    "run_command",
+    "get_window_info",
+    "get_desktop_info",
+    "move_wins",
+    "move_matching_windows",
+    "move_windows",
+    "rename",
+    "rename_many",
+    "switch",
+    "set_num_desktops",
+    "wait_until_applied",
+    "list_workspaces",
+    "find_windows",
+    "goto",
+    "insert_before",
+    "swap",
+    "swapleft",
+    "swapright",
+    "delete",
+    "move",
+    "compact",
+    "reorder_desktops",
+    "sort_desktops",
+    "change_layout",
+    "apply_plan",
+    "batch",
+    "save_layout",
+    "restore_layout",
+]
+untraced_functions = {}
 
 
-def get_window_info(desktop):
-    """Returns an array of tuples:
-    (win_id, win_desktop, win_name)"""
-    debug(f"get_window_info: d {desktop}")
-    window_info = []
-    result = run_command("wmctrl -l")
-    windows = result.split("\n")
-    for window in windows:
-        a = window.split(" ")
-        if len(a) < 3:
+def trace_path():
+    import tempfile
+
+    default = os.path.join(tempfile.gettempdir(), "workspace_trace.json")
+    return os.environ.get("WORKSPACE_TRACE", default)
+
+
+def traced(func, name):
+    """Returns func wrapped to append a Chrome trace "complete" event named
+    name to trace_spans for every call."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            end = time.perf_counter()
+            span = {
+                "name": name,
+                "cat": "operation",
+                "ph": "X",
+                "ts": start * 1000000,
+                "dur": (end - start) * 1000000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": {"args": [repr(a) for a in args]},
+            }
+            if name == "run_command" and args:
+                span["name"] = " ".join(args[0][:2])
+                span["cat"] = "command"
+                span["args"] = {"argv": list(args[0])}
+                if isinstance(result, CommandResult):
+                    span["args"]["returncode"] = result.returncode
+                    span["args"]["output_bytes"] = len(result.stdout)
+            if trace_spans is not None:
+                trace_spans.append(span)
+
+    return wrapper
+
+
+def start_tracing():
+    global trace_spans
+    if trace_spans is not None:
+        return
+    trace_spans = []
+    for name in traced_functions:
+        untraced_functions[name] = globals()[name]
+        globals()[name] = traced(untraced_functions[name], name)
+
+
+def finish_tracing():
+    """Stops tracing and writes the spans to trace_path().
+
+    Paths ending in .jsonl get one span per line, anything else gets a Chrome
+    trace-event file that chrome://tracing or Perfetto can open."""
+    global trace_spans
+    if trace_spans is None:
+        return
+    globals().update(untraced_functions)
+    untraced_functions.clear()
+    spans = trace_spans
+    trace_spans = None
+    path = trace_path()
+    with open(path, "w") as f:
+        if path.endswith(".jsonl"):
+            for span in spans:
+                f.write(json.dumps(span) + "\n")
+        else:
+            json.dump({"traceEvents": spans, "displayTimeUnit": "ms"}, f)
+    print(f"trace written to {path}", file=sys.stderr)
+
+
+# Seconds a command may run before it is killed. Dialogs wait for the user so
+# they get much longer.
+command_timeout = 5
+dialog_timeout = 300
+
+
+class CommandResult:
+    """The outcome of run_command.
+
+    returncode is None if the command timed out."""
+
+    def __init__(self, argv, returncode, stdout="", stderr="", elapsed=0.0):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def error_message(self):
+        if self.returncode is None:
+            return f"Error: {self.argv[0]} timed out\n{self.stderr}"
+        return f"Error: code {self.returncode}\n{self.stderr}"
+
+
+def run_command(argv, stdin="", timeout=None):
+    """Runs argv without a shell and returns a CommandResult."""
+    if timeout is None:
+        timeout = command_timeout
+    start = time.monotonic()
+    try:
+        result = subprocess.run(
+            argv, input=stdin, capture_output=True, text=True, timeout=timeout
+        )
+    except subprocess.TimeoutExpired as e:
+        stderr = e.stderr or ""
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode("utf-8", "replace")
+        return CommandResult(argv, None, "", stderr, time.monotonic() - start)
+    except OSError as e:
+        return CommandResult(argv, 127, "", f"{e}\n", time.monotonic() - start)
+    elapsed = time.monotonic() - start
+    return CommandResult(argv, result.returncode, result.stdout, result.stderr, elapsed)
+
+
+class EwmhConnection:
+    """Reads and changes the desktop state through the EWMH properties on the
+    root window, using a single X connection instead of one wmctrl process
+    per query or window move."""
+
+    def __init__(self, display_name=None):
+        if import_xlib() is None:
+            raise RuntimeError("The ewmh backend requires python-xlib")
+        self.display = Xlib.display.Display(display_name)
+        self.root = self.display.screen().root
+        self._atoms = {}
+
+    def atom(self, name):
+        if name not in self._atoms:
+            self._atoms[name] = self.display.intern_atom(name)
+        return self._atoms[name]
+
+    def get_property(self, window, name, prop_type=None):
+        if prop_type is None:
+            prop_type = Xlib.X.AnyPropertyType
+        prop = window.get_full_property(self.atom(name), prop_type)
+        if prop is None:
+            return None
+        return prop.value
+
+    def get_cardinal(self, window, name, default=None):
+        value = self.get_property(window, name)
+        if value is None or len(value) == 0:
+            return default
+        value = int(value[0])
+        # Sticky windows are on desktop 0xFFFFFFFF, which wmctrl shows as -1.
+        if value == 0xFFFFFFFF:
+            return -1
+        return value
+
+    def get_string(self, window, name):
+        value = self.get_property(window, name, self.atom("UTF8_STRING"))
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "replace")
+        return value
+
+    def get_window_name(self, window):
+        name = self.get_string(window, "_NET_WM_NAME")
+        if name is None:
+            name = window.get_wm_name()
+        if isinstance(name, bytes):
+            name = name.decode("latin-1")
+        return name or ""
+
+    def get_client_list(self):
+        value = self.get_property(self.root, "_NET_CLIENT_LIST")
+        if value is None:
+            return []
+        return [int(win_id) for win_id in value]
+
+    def get_window_desktops(self, win_ids):
+        """Returns the desktop of each window, or None for a window that has
+        gone away."""
+        desktops = []
+        for win_id in win_ids:
+            window = self.display.create_resource_object("window", win_id)
+            try:
+                desktops.append(self.get_cardinal(window, "_NET_WM_DESKTOP", -1))
+            except Xlib.error.XError:
+                desktops.append(None)
+        return desktops
+
+    def get_desktop_names(self):
+        names = self.get_string(self.root, "_NET_DESKTOP_NAMES")
+        if not names:
+            return []
+        return names.rstrip("\0").split("\0")
+
+    def get_window_info(self, desktop):
+        window_info = []
+        for win_id in self.get_client_list():
+            window = self.display.create_resource_object("window", win_id)
+            try:
+                win_desktop = self.get_cardinal(window, "_NET_WM_DESKTOP", -1)
+                if desktop != "none" and win_desktop != int(desktop):
+                    continue
+                win_name = self.get_window_name(window)
+                pid = self.get_cardinal(window, "_NET_WM_PID", 0)
+                wm_class = window.get_wm_class()
+            except Xlib.error.XError:
+                # The window was closed while we were looking at it.
+                continue
+            # wmctrl shows a missing class as N/A.
+            wm_class = ".".join(wm_class) if wm_class else "N/A"
+            window_info.append(WindowInfo(win_id, win_desktop, win_name, pid, wm_class))
+        return window_info
+
+    def get_desktop_info(self):
+        num = self.get_cardinal(self.root, "_NET_NUMBER_OF_DESKTOPS", 0)
+        names = self.get_desktop_names()
+        desktop_info = {}
+        desktop_info["curr"] = self.get_cardinal(self.root, "_NET_CURRENT_DESKTOP", 0)
+        desktop_info["list"] = []
+        for i in range(num):
+            name = "N/A"
+            if i < len(names):
+                name = names[i]
+            desktop_info["list"].append(Desktop(i, name, i == desktop_info["curr"]))
+        desktop_info["num"] = num
+        return desktop_info
+
+    def send_message(self, window, name, data):
+        data = (list(data) + [0] * 5)[:5]
+        data = [d & 0xFFFFFFFF for d in data]
+        event = Xlib.protocol.event.ClientMessage(
+            window=window, client_type=self.atom(name), data=(32, data)
+        )
+        mask = Xlib.X.SubstructureRedirectMask | Xlib.X.SubstructureNotifyMask
+        self.root.send_event(event, event_mask=mask)
+        self.display.flush()
+
+    def move_window_to_desktop(self, win_id, desktop):
+        window = self.display.create_resource_object("window", win_id)
+        # Source indication 2 tells the window manager a pager sent this.
+        self.send_message(window, "_NET_WM_DESKTOP", [int(desktop), 2])
+
+    def set_desktop_names(self, names):
+        value = "".join(name + "\0" for name in names).encode()
+        self.root.change_property(
+            self.atom("_NET_DESKTOP_NAMES"), self.atom("UTF8_STRING"), 8, value
+        )
+        self.display.flush()
+
+    def activate_window(self, win_id):
+        window = self.display.create_resource_object("window", win_id)
+        self.send_message(window, "_NET_ACTIVE_WINDOW", [2, Xlib.X.CurrentTime])
+
+    def set_num_desktops(self, num):
+        self.send_message(self.root, "_NET_NUMBER_OF_DESKTOPS", [int(num)])
+
+    def switch(self, desktop):
+        self.send_message(
+            self.root, "_NET_CURRENT_DESKTOP", [int(desktop), Xlib.X.CurrentTime]
+        )
+
+    def watch_changes(self):
+        """Asks X for PropertyNotify events on the root window and on every
+        client window, so that next_change can report changes."""
+        self._root_atoms = set(
+            self.atom(name)
+            for name in [
+                "_NET_CLIENT_LIST",
+                "_NET_CURRENT_DESKTOP",
+                "_NET_DESKTOP_NAMES",
+                "_NET_NUMBER_OF_DESKTOPS",
+            ]
+        )
+        self._window_atoms = set(
+            self.atom(name) for name in ["_NET_WM_DESKTOP", "_NET_WM_NAME", "WM_NAME"]
+        )
+        self._watched = set()
+        self.root.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+        self._watch_clients()
+
+    def _watch_clients(self):
+        clients = set(self.get_client_list())
+        for win_id in clients - self._watched:
+            window = self.display.create_resource_object("window", win_id)
+            window.change_attributes(
+                event_mask=Xlib.X.PropertyChangeMask, onerror=Xlib.error.CatchError()
+            )
+        self._watched = clients
+        self.display.flush()
+
+    def next_change(self, timeout=None):
+        """Blocks until the desktops, their names, the current desktop, the
+        client list or a window's desktop or title changes.
+
+        Returns False if timeout seconds pass without a change."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            while self.display.pending_events():
+                event = self.display.next_event()
+                if event.type != Xlib.X.PropertyNotify:
+                    continue
+                if event.window.id == self.root.id:
+                    if event.atom not in self._root_atoms:
+                        continue
+                    if event.atom == self.atom("_NET_CLIENT_LIST"):
+                        self._watch_clients()
+                    return True
+                if event.atom in self._window_atoms:
+                    return True
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+            readable, _, _ = select.select([self.display], [], [], remaining)
+            if not readable:
+                return False
+
+
+ewmh_connection = None
+
+
+def ewmh():
+    """Returns the shared EwmhConnection, connecting on first use."""
+    global ewmh_connection
+    if ewmh_connection is None:
+        ewmh_connection = EwmhConnection()
+    return ewmh_connection
+
+
+# While the daemon runs it keeps the last listings here between commands, and
+# empties it whenever X reports a change. None means nothing is cached.
+state_cache = None
+state_cache_lock = threading.Lock()
+state_cache_generation = 0
+
+
+def cached_state(key, load):
+    """Returns state_cache[key], calling load() to fill it in if needed."""
+    # The daemon's watcher thread may turn the cache off at any time.
+    cache = state_cache
+    if cache is None:
+        return load()
+    with state_cache_lock:
+        if key in cache:
+            return cache[key]
+        generation = state_cache_generation
+    value = load()
+    with state_cache_lock:
+        # Don't keep the value if it may have changed while we were loading it.
+        if generation == state_cache_generation:
+            cache[key] = value
+    return value
+
+
+def invalidate_state_cache():
+    global state_cache_generation
+    with state_cache_lock:
+        state_cache_generation += 1
+        if state_cache is not None:
+            state_cache.clear()
+
+
+# Commands run outside the daemon keep their listings in the state file, so a
+# status bar polling "list" doesn't list everything every time. An entry is
+# used for up to state_file_ttl seconds and, when python-xlib can read X, only
+# while the desktops and the window list still look the same. "--fresh"
+# ignores the file.
+state_file_ttl = 2.0
+# The window manager may still be applying a change for a moment after the
+# command that made it returns, so nothing is saved for this many seconds
+# after the file is invalidated.
+state_file_settle = 0.5
+fresh = False
+# Commands that may answer from the state file, and the state_cache keys kept
+# in it.
+state_file_commands = ["list", "listwin", "find", "goto", "gui_switch"]
+state_file_keys = ["desktops", "windows"]
+
+
+def state_file_path():
+    return runtime_path(".state.json")
+
+
+def state_file_lock():
+    """Held while the state file is read and written back, so an
+    invalidation is never lost under a save."""
+    return file_lock(runtime_path(".state.lock"))
+
+
+def state_fingerprint():
+    """Returns a summary of the desktops, the window list and the desktop of
+    each window that is cheap to read from X, or None if X can't be read
+    directly."""
+    if not os.environ.get("DISPLAY") or import_xlib() is None:
+        return None
+    try:
+        connection = ewmh()
+        clients = connection.get_client_list()
+        return [
+            connection.get_cardinal(connection.root, "_NET_NUMBER_OF_DESKTOPS", 0),
+            connection.get_cardinal(connection.root, "_NET_CURRENT_DESKTOP", 0),
+            connection.get_desktop_names(),
+            clients,
+            connection.get_window_desktops(clients),
+        ]
+    except (OSError, Xlib.error.DisplayError, Xlib.error.XError) as e:
+        debug(f"state_fingerprint: {e}")
+        return None
+
+
+def read_state_file():
+    try:
+        with open(state_file_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state_file(saved):
+    import tempfile
+
+    path = state_file_path()
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    except OSError as e:
+        debug(f"write_state_file: {e}")
+        return
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(saved, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        debug(f"write_state_file: {e}")
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+
+
+def load_state_file():
+    """Turns on state_cache and fills it in from the state file.
+
+    Returns what save_state_file needs to know about this run."""
+    global state_cache
+    run = {"started": time.time(), "fingerprint": state_fingerprint()}
+    state_cache = {}
+    saved = read_state_file()
+    for key in state_file_keys:
+        entry = saved.get(key)
+        if entry is None:
+            continue
+        if entry["fingerprint"] != run["fingerprint"]:
+            continue
+        if not 0 <= run["started"] - entry["time"] < state_file_ttl:
+            continue
+        value = entry["value"]
+        if key == "windows":
+            value = [WindowInfo(*w) for w in value]
+        else:
+            value["list"] = [Desktop(*d) for d in value["list"]]
+        state_cache[key] = value
+    run["loaded"] = set(state_cache)
+    return run
+
+
+def save_state_file(run):
+    """Adds the listings this run read from X to the state file."""
+    new_keys = [k for k in state_file_keys if k in state_cache]
+    new_keys = [k for k in new_keys if k not in run["loaded"]]
+    if not new_keys:
+        return
+    with state_file_lock():
+        saved = read_state_file()
+        # Something changed the desktops while we were running, or only just
+        # before, so what we read may already be out of date.
+        if saved.get("invalidated", 0) + state_file_settle >= run["started"]:
+            return
+        for key in new_keys:
+            saved[key] = {
+                "time": run["started"],
+                "fingerprint": run["fingerprint"],
+                "value": state_cache[key],
+            }
+        write_state_file(saved)
+
+
+def invalidate_state_file():
+    """Drops every entry of the state file, after a command changed the
+    desktops."""
+    with state_file_lock():
+        write_state_file({"invalidated": time.time()})
+
+
+# One window, as listed by "wmctrl -l -p -G -x". id and desktop are ints, and
+# desktop is -1 for sticky windows. The ewmh backend doesn't read the geometry
+# and leaves it None.
+WindowInfo = collections.namedtuple(
+    "WindowInfo",
+    ["id", "desktop", "title", "pid", "wm_class", "x", "y", "width", "height"],
+    defaults=[None] * 6,
+)
+
+# One desktop, as listed by "wmctrl -d". num is an int.
+Desktop = collections.namedtuple(
+    "Desktop",
+    ["num", "name", "current", "geometry", "workarea"],
+    defaults=[False, None, None],
+)
+
+list_windows_argv = ["wmctrl", "-l", "-p", "-G", "-x"]
+
+# The numeric columns are padded to different widths by different wmctrl
+# versions, so they are matched as runs of spaces. The rest of the line is the
+# class, padded with spaces, the host name and, after a single space, the title
+# exactly as wmctrl printed it. A class may contain spaces, so the rest is split
+# at the first known host name; see split_class_host_title.
+window_line = re.compile(
+    r"(0x[0-9a-fA-F]+)\s+(-?\d+)\s+(\d+)\s+(-?\d+)\s+(-?\d+)\s+(\d+)\s+(\d+)\s+(.*)$"
+)
+# The start of a window line, for lines whose other columns can't be read.
+window_line_start = re.compile(r"(0x[0-9a-fA-F]+)\s+(-?\d+)\s(.*)$")
+desktop_line = re.compile(
+    r"(\d+)\s+([*-])\s+DG: (\S+)\s+VP: \S+\s+WA: (\S+(?: \d+x\d+)?)(?:\s+(.*))?$"
+)
+
+
+def window_id(win_id):
+    """Formats a window ID the way wmctrl prints it."""
+    return f"0x{win_id:08x}"
+
+
+def window_hosts():
+    """Returns the host names wmctrl may print for local windows."""
+    hostname = socket.gethostname()
+    return [hostname, hostname.split(".")[0], "N/A"]
+
+
+def split_class_host_title(rest, hosts):
+    """Splits what follows the numeric columns of a "wmctrl -l -p -G -x" line
+    into (class, title).
+
+    The class ends just before the first of hosts. If none of them is there
+    the window is on another host, so the class is taken to be one word."""
+    for host in hosts:
+        match = re.match(r"(.*?)\s+" + re.escape(host) + r"(?: (.*))?$", rest)
+        if match is not None:
+            return match.group(1), match.group(2) or ""
+    wm_class, _, rest = rest.partition(" ")
+    host_and_title = rest.lstrip(" ")
+    return wm_class, host_and_title.partition(" ")[2]
+
+
+def parse_window_list(lines):
+    """Yields a WindowInfo for each line of "wmctrl -l -p -G -x" output.
+
+    A window whose line can only partly be read gets its ID, desktop and the
+    rest of the line as its title. Lines that aren't windows at all are
+    reported, since a missing window could make a desktop look empty."""
+    hosts = window_hosts()
+    for line in lines:
+        line = line.rstrip("\n")
+        match = window_line.match(line)
+        if match is not None:
+            win_id, desktop, pid, x, y, width, height, rest = match.groups()
+            wm_class, title = split_class_host_title(rest, hosts)
+            yield WindowInfo(
+                int(win_id, 16),
+                int(desktop),
+                title,
+                int(pid),
+                wm_class,
+                int(x),
+                int(y),
+                int(width),
+                int(height),
+            )
             continue
-        win_id = a[0]
-        i = 1
-        if a[i] == "":
-            i += 1
-        win_desktop = a[i]
-        if desktop != "none" and int(win_desktop) != int(desktop):
+        match = window_line_start.match(line)
+        if match is not None:
+            win_id, desktop, title = match.groups()
+            debug(f"parse_window_list: only partly parsed [{line}]")
+            yield WindowInfo(int(win_id, 16), int(desktop), title.strip())
+        elif line.strip():
+            print(f"Error: Can't parse this line of the window list: {line}")
+
+
+def parse_desktop_list(lines):
+    """Yields a Desktop for each line of "wmctrl -d" output."""
+    for line in lines:
+        match = desktop_line.match(line.rstrip("\n"))
+        if match is None:
+            if line.strip():
+                debug(f"parse_desktop_list: can't parse [{line.rstrip()}]")
             continue
-        i += 2
-        win_name = " ".join(a[i:])
-        debug(f"get_window_info: {win_id} {win_desktop} {win_name}")
-        window_info.append((win_id, win_desktop, win_name))
-    return window_info
+        num, curr, geometry, workarea, name = match.groups()
+        yield Desktop(int(num), name or "", curr == "*", geometry, workarea)
+
+
+def get_window_info(desktop):
+    """Returns an array of WindowInfo, for every window or only those on
+    desktop."""
+    debug(f"get_window_info: d {desktop}")
+    window_info = cached_state("windows", read_window_info)
+    if desktop == "none":
+        return list(window_info)
+    return [w for w in window_info if w.desktop == int(desktop)]
+
+
+def read_window_info():
+    if backend == "ewmh":
+        return ewmh().get_window_info("none")
+    result = run_command(list_windows_argv)
+    return list(parse_window_list(io.StringIO(result.stdout)))
+
+
+def try_move_window_to_desktop(win_id, desktop):
+    """Moves a window and returns the error message, or None on success."""
+    debug(f"move_window_to_desktop: w {window_id(win_id)} -> d {desktop}")
+    if backend == "ewmh":
+        ewmh().move_window_to_desktop(win_id, desktop)
+        return None
+    argv = ["wmctrl", "-i", "-r", window_id(win_id), "-t", str(desktop)]
+    result = run_command(argv)
+    if not result.ok:
+        return result.error_message()
+    return None
+
+
+# The most window moves to run at the same time.
+max_parallel_moves = 8
+
+
+def move_windows(moves, max_workers=None):
+    """Moves several windows at once.
+
+    moves is an array of tuples(win_id, desktop). The moves are independent, so
+    up to max_workers of them run concurrently. Failures are collected and
+    reported together once every move has finished."""
+    if not moves:
+        return
+    if max_workers is None:
+        max_workers = max_parallel_moves
+    if backend == "ewmh" or max_workers <= 1 or len(moves) == 1:
+        # The ewmh backend only queues a message on its connection, so there
+        # is nothing to wait for in parallel.
+        errors = [try_move_window_to_desktop(*m) for m in moves]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            errors = list(pool.map(lambda m: try_move_window_to_desktop(*m), moves))
+    failures = [(m, e) for (m, e) in zip(moves, errors) if e is not None]
+    if not failures:
+        return
+    print(f"Error: {len(failures)} of {len(moves)} window moves failed")
+    for (win_id, desktop), error in failures:
+        print(f"  {window_id(win_id)} -> {desktop}: {error.strip()}")
+
+
+def wait_until_applied(names=None, num=None, windows=None, curr=None, timeout=None):
+    """Blocks until the window manager shows the expected state.
+
+    names maps desktop numbers to their expected names, num is the expected
+    number of desktops, windows maps win_ids to their expected desktop and curr
+    is the expected current desktop. Anything left as None isn't checked.
+    Returns False if the state isn't seen within timeout seconds."""
+    if timeout is None:
+        timeout = wait_timeout
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+    connection = None
+    if backend == "ewmh":
+        # Listen before the first check so no change can slip in between.
+        connection = EwmhConnection()
+        connection.watch_changes()
+    try:
+        while not state_applied(names, num, windows, curr):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if connection is not None:
+                connection.next_change(remaining)
+            else:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, 0.25)
+        return True
+    finally:
+        if connection is not None:
+            connection.display.close()
+
+
+def state_applied(names, num, windows, curr):
+    # Always read afresh; the cached listings may be what we are waiting on.
+    if names or num is not None or curr is not None:
+        desktop_info = read_desktop_info()
+        if num is not None and desktop_info["num"] != num:
+            return False
+        if curr is not None and desktop_info.get("curr") != curr:
+            return False
+        for desktop, name in (names or {}).items():
+            if desktop >= desktop_info["num"]:
+                return False
+            if desktop_info["list"][desktop].name != name:
+                return False
+    if windows:
+        actual = {w.id: w.desktop for w in read_window_info()}
+        for win_id, desktop in windows.items():
+            # Windows that were closed in the meantime can't be waited for.
+            if win_id in actual and actual[win_id] != desktop:
+                return False
+    return True
+
+
+def expect_applied(**expected):
+    """Waits for the expected state if the "wait" keyword was given."""
+    if not wait_applied:
+        return
+    if not wait_until_applied(**expected):
+        print("Error: Timed out waiting for the window manager to apply the changes")
+
 
+def get_window_index():
+    """Returns a map from desktop number (an int) to the array of WindowInfo
+    records on that desktop, built from a single window listing."""
+    return index_windows(get_window_info("none"))
 
-def move_window_to_desktop(win_id, desktop):
-    debug(f"move_window_to_desktop: w {win_id} -> d {desktop}")
-    result = run_command(f"wmctrl -i -r {win_id} -t {desktop}")
-    if result.startswith("Error:"):
-        print(result)
+
+def index_windows(window_info):
+    window_index = {}
+    for win_info in window_info:
+        window_index.setdefault(win_info.desktop, []).append(win_info)
+    return window_index
+
+
+def desktop_number(desktop):
+    """Returns desktop as an int, or None after printing why it isn't one."""
+    try:
+        return int(desktop)
+    except ValueError:
+        if desktop in ["none", ""]:
+            print("Error: Please specify a desktop number")
+        else:
+            print(f"Error: Not a desktop number: {desktop}")
+        return None
 
 
 def move_wins(source_desktop, dest_desktop):
+    """Moves all the windows from source_desktop to dest_desktop."""
     debug(f"move_wins: d {source_desktop} -> d {dest_desktop}")
-    for win_info in get_window_info(source_desktop):
-        move_window_to_desktop(win_info[0], dest_desktop)
+    source_desktop = desktop_number(source_desktop)
+    if source_desktop is None:
+        return
+    dest_desktop = desktop_number(dest_desktop)
+    if dest_desktop is None:
+        return
+    windows = get_window_info(source_desktop)
+    move_windows([(w.id, dest_desktop) for w in windows])
+    expect_applied(windows={w.id: dest_desktop for w in windows})
+
+
+# Options of the filtered form of movewins. Each takes a value.
+window_filter_options = ["--class", "--title", "--pid", "--from", "--to"]
+
+
+def parse_window_filter(args):
+    """Returns a map from option name, without the dashes, to its value."""
+    options = {}
+    for i in range(0, len(args), 2):
+        if args[i] not in window_filter_options:
+            raise ValueError(f"Unknown option: {args[i]}")
+        if i + 1 >= len(args):
+            raise ValueError(f"Missing value for {args[i]}")
+        options[args[i][2:]] = args[i + 1]
+    return options
+
+
+def parse_desktop_ranges(text):
+    """Returns the set of desktops in a list like "3,5-7"."""
+    desktops = set()
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        if not first.isdigit() or not (last or first).isdigit():
+            raise ValueError(f"Bad desktop range: {part}")
+        desktops.update(range(int(first), int(last or first) + 1))
+    return desktops
+
+
+def text_matcher(pattern):
+    """Matches text containing pattern, ignoring case, or matching the regular
+    expression after a leading ~."""
+    if pattern.startswith("~"):
+        regex = re.compile(pattern[1:], re.IGNORECASE)
+        return lambda text: regex.search(text) is not None
+    pattern = pattern.lower()
+    return lambda text: pattern in text.lower()
+
+
+def window_filter(options):
+    """Returns a function that tells whether a WindowInfo passes every filter
+    in options. Sticky windows never do."""
+    tests = [lambda w: w.desktop >= 0]
+    if "class" in options:
+        class_matches = text_matcher(options["class"])
+        tests.append(lambda w: class_matches(w.wm_class))
+    if "title" in options:
+        title_matches = text_matcher(options["title"])
+        tests.append(lambda w: title_matches(w.title))
+    if "pid" in options:
+        pid = int(options["pid"])
+        tests.append(lambda w: w.pid == pid)
+    if "from" in options:
+        desktops = parse_desktop_ranges(options["from"])
+        tests.append(lambda w: w.desktop in desktops)
+    return lambda w: all(test(w) for test in tests)
+
+
+def move_matching_windows(args):
+    """Moves every window that passes the filters in args to the desktop given
+    with --to, from one window listing and as one batch of moves."""
+    try:
+        options = parse_window_filter(args)
+        if "to" not in options:
+            raise ValueError("Please give the desktop to move to with --to")
+        dest_desktop = int(options["to"])
+        matches = window_filter(options)
+    except (ValueError, re.error) as e:
+        print(f"Error: {e}")
+        return
+    num = get_desktop_info()["num"]
+    if dest_desktop < 0 or dest_desktop >= num:
+        print(f"Error: Desktop number must range from 0 to {num - 1}")
+        return
+    windows = [
+        w for w in get_window_info("none") if w.desktop != dest_desktop and matches(w)
+    ]
+    debug(f"move_matching_windows: {len(windows)} windows -> d {dest_desktop}")
+    move_windows([(w.id, dest_desktop) for w in windows])
+    expect_applied(windows={w.id: dest_desktop for w in windows})
+
+
+def workspace_summary(desktop_info, window_info):
+    """Returns an array with a map for each desktop: its "num", "name",
+    number of "windows" and whether it is "current"."""
+    num_windows = collections.Counter(w.desktop for w in window_info)
+    debug(f"workspace_summary: d to #w: {dict(num_windows)}")
+    return [
+        {
+            "num": d.num,
+            "name": d.name,
+            "windows": num_windows[d.num],
+            "current": d.num == desktop_info.get("curr"),
+        }
+        for d in desktop_info["list"]
+    ]
+
+
+def format_workspace(d):
+    curr = "*" if d["current"] else "-"
+    return " ".join(["%3s " % d["num"], curr, "%2d " % d["windows"], d["name"]])
 
 
 def list_workspaces():
-    desktop_info = get_desktop_info()
-    desktop_to_num_windows = {}
-    win_info = get_window_info("none")
-    for w in win_info:
-        if not w[1] in desktop_to_num_windows:
-            desktop_to_num_windows[w[1]] = 0
-        desktop_to_num_windows[w[1]] += 1
-    debug(f"list_workspaces: d to #w: {desktop_to_num_windows}")
-    for d in desktop_info["list"]:
-        num_windows = 0
-        if d[0] in desktop_to_num_windows:
-            num_windows = desktop_to_num_windows[d[0]]
-        curr = "-"
-        if int(d[0]) == desktop_info["curr"]:
-            curr = "*"
-        print("%3s " % d[0], curr, "%2d " % num_windows, d[1])
+    summary = workspace_summary(get_desktop_info(), get_window_info("none"))
+    for d in summary:
+        print(format_workspace(d))
+
+
+# How often watch lists the workspaces when X can't tell it about changes,
+# and how long it lets a burst of changes settle before listing them.
+watch_interval = 1.0
+watch_settle = 0.05
+
+
+def watch(output_format, connection=None, max_updates=None):
+    """Prints the workspaces, then again every time they change, until
+    interrupted. The text format is that of list_workspaces followed by a
+    blank line; the json format is one line per update."""
+    if output_format not in ["none", "--json"]:
+        print(f"Error: Unknown option: {output_format}")
+        return
+    if connection is None and os.environ.get("DISPLAY") and import_xlib():
+        connection = EwmhConnection()
+        connection.watch_changes()
+    last = None
+    updates = 0
+    try:
+        while True:
+            summary = workspace_summary(read_desktop_info(), read_window_info())
+            if summary != last:
+                if output_format == "--json":
+                    print(json.dumps(summary))
+                else:
+                    print("\n".join(format_workspace(d) for d in summary) + "\n")
+                sys.stdout.flush()
+                last = summary
+                updates += 1
+                if max_updates is not None and updates >= max_updates:
+                    return
+            wait_for_change(connection)
+    except (KeyboardInterrupt, BrokenPipeError):
+        pass
+
+
+def wait_for_change(connection):
+    if connection is None:
+        time.sleep(watch_interval)
+        return
+    connection.next_change()
+    while connection.next_change(timeout=watch_settle):
+        pass
 
 
 def list_windows(desktop):
     for win_info in get_window_info(desktop):
-        print(win_info[0], "%3s " % win_info[1], win_info[2])
+        print_window(win_info)
+
+
+def print_window(win_info):
+    print(window_id(win_info.id), "%3s " % win_info.desktop, win_info.title)
+
+
+def trigrams(text):
+    return set(text[i : i + 3] for i in range(len(text) - 2))
+
+
+class TitleIndex:
+    """A trigram index over window titles, so a search only looks at the
+    windows that share every trigram with the query instead of at all of
+    them."""
+
+    def __init__(self, window_info):
+        self.windows = list(window_info)
+        self.titles = [w.title.lower() for w in self.windows]
+        # map from trigram to the set of positions in self.windows whose title
+        # contains it.
+        self.postings = {}
+        for i, title in enumerate(self.titles):
+            for trigram in trigrams(title):
+                self.postings.setdefault(trigram, set()).add(i)
+
+    def candidates(self, terms):
+        found = None
+        for term in terms:
+            for trigram in trigrams(term):
+                matches = self.postings.get(trigram, set())
+                found = matches if found is None else found & matches
+                if not found:
+                    return []
+        if found is None:
+            # Every term is shorter than a trigram.
+            return range(len(self.windows))
+        return sorted(found)
+
+    def search(self, query):
+        """Returns the WindowInfo records whose title contains every word of query,
+        ignoring case, best match first.
+
+        Exact titles rank first, then titles starting with the query, then
+        titles where more of the words start a word, then shorter titles."""
+        query = query.lower().strip()
+        terms = query.split()
+        ranked = []
+        for i in self.candidates(terms):
+            title = self.titles[i]
+            if not all(term in title for term in terms):
+                continue
+            words = title.split()
+            at_word_start = sum(
+                1 for term in terms if any(w.startswith(term) for w in words)
+            )
+            rank = (title == query, title.startswith(query), at_word_start)
+            ranked.append((rank, -len(title), -i, self.windows[i]))
+        ranked.sort(reverse=True)
+        return [r[3] for r in ranked]
+
+
+def title_index():
+    """Returns a TitleIndex over every window. The daemon keeps it between
+    commands until the windows change."""
+    return cached_state("title_index", lambda: TitleIndex(get_window_info("none")))
+
+
+def find_windows(query):
+    for win_info in title_index().search(query):
+        print_window(win_info)
+
+
+def goto(query):
+    """Switches to the workspace of the window best matching query and
+    activates the window."""
+    if not query.strip():
+        print("Error: Please give the text to search window titles for")
+        return
+    matches = title_index().search(query)
+    if not matches:
+        print(f"Error: No window matches: {query}")
+        return
+    best = matches[0]
+    debug(f"goto: {window_id(best.id)} d {best.desktop} {best.title}")
+    activate_window(best.id, best.desktop)
+
+
+def activate_window(win_id, desktop):
+    if backend == "ewmh":
+        if desktop >= 0:
+            ewmh().switch(desktop)
+        ewmh().activate_window(win_id)
+    else:
+        # wmctrl switches to the window's workspace before raising it.
+        result = run_command(["wmctrl", "-i", "-a", window_id(win_id)])
+        if not result.ok:
+            print(result.error_message())
+            return
+    if desktop >= 0:
+        expect_applied(curr=desktop)
 
 
 def rename(desktop, new_name):
     debug(f"rename: d {desktop} -> [{new_name}]")
-    # TODO: Add support for other window managers besides Marco.
-    rename_marco(desktop, new_name)
+    desktop = desktop_number(desktop)
+    if desktop is None:
+        return
+    error = names_backend_error()
+    if error is not None:
+        print(error)
+        return
+    rename_one = name_backends[get_names_backend()]["rename"]
+    if rename_one is not None:
+        rename_one(desktop, new_name)
+    else:
+        rename_many([(desktop, new_name)])
+    expect_applied(names={desktop: new_name})
 
 
 def rename_marco(desktop, new_name):
     # workspace-names are numbered from 1 but in wmctrl they are numbered from 0.
     desktop = int(desktop) + 1
     result = run_command(
-        f'gsettings set org.mate.Marco.workspace-names name-{desktop} "{new_name}"'
+        [
+            "gsettings",
+            "set",
+            "org.mate.Marco.workspace-names",
+            f"name-{desktop}",
+            new_name,
+        ]
     )
-    if result.startswith("Error:"):
-        print(result)
+    if not result.ok:
+        print(result.error_message())
+
+
+def rename_many(renames, names=None):
+    """Renames several desktops in one write.
+
+    renames is an array of tuples(desktop, new_name). names is every desktop
+    name once the renames are done, for the backends that can only write the
+    whole list. If it is None it is worked out from get_desktop_info()."""
+    if not renames:
+        return
+    debug(f"rename_many: {renames}")
+    backend_name = get_names_backend()
+    if backend_name == "marco":
+        rename_marco_many(renames)
+        return
+    if names is None:
+        desktop_info = get_desktop_info()
+        num = max([desktop_info["num"]] + [int(d) + 1 for d, _ in renames])
+        names = names_after(desktop_info, num, renames)
+    name_backends[backend_name]["rename_many"](names)
+
+
+def names_after(desktop_info, num, renames):
+    """Returns the names of num desktops after renames, keeping the names in
+    desktop_info for the others."""
+    names = [d.name for d in desktop_info["list"][:num]]
+    names += [""] * (num - len(names))
+    for desktop, new_name in renames:
+        names[int(desktop)] = new_name
+    return names
+
+
+def gvariant_string(value):
+    escaped = value.replace("\\", "\\\\").replace("'", "\\'")
+    return f"'{escaped}'"
+
+
+def rename_marco_many(renames):
+    # dconf load applies the whole keyfile as one change, so Marco re-reads its
+    # settings once instead of once per name.
+    keyfile = "[/]\n"
+    for desktop, new_name in renames:
+        keyfile += f"name-{int(desktop) + 1}={gvariant_string(new_name)}\n"
+    result = run_command(["dconf", "load", "/org/mate/marco/workspace-names/"], keyfile)
+    if not result.ok:
+        print(result.error_message())
+
+
+def rename_xfwm_all(names):
+    argv = ["xfconf-query", "-c", "xfwm4", "-p", "/general/workspace_names"]
+    argv += ["-n", "--force-array"]
+    for name in names:
+        argv += ["-t", "string", "-s", name]
+    result = run_command(argv)
+    if not result.ok:
+        print(result.error_message())
+
+
+def rename_mutter_all(names):
+    value = "[" + ", ".join(gvariant_string(name) for name in names) + "]"
+    argv = ["gsettings", "set", "org.gnome.desktop.wm.preferences"]
+    argv += ["workspace-names", value]
+    result = run_command(argv)
+    if not result.ok:
+        print(result.error_message())
+
+
+def rename_ewmh_all(names):
+    ewmh().set_desktop_names(names)
+
+
+# Ways of setting workspace names, by window manager. "rename" renames one
+# desktop, or is None if the backend has to write every name at once.
+# "rename_many" is called with every name, except for Marco, which takes the
+# array of tuples(desktop, new_name) that changed.
+name_backends = {
+    "marco": {"rename": rename_marco, "rename_many": rename_marco_many},
+    "xfwm": {"rename": None, "rename_many": rename_xfwm_all},
+    "mutter": {"rename": None, "rename_many": rename_mutter_all},
+    "ewmh": {"rename": None, "rename_many": rename_ewmh_all},
+}
+
+# Set from $WORKSPACE_NAMES_BACKEND, or from $XDG_CURRENT_DESKTOP on first use.
+names_backend = None
+
+
+def detect_names_backend(environ):
+    override = environ.get("WORKSPACE_NAMES_BACKEND")
+    if override in name_backends:
+        return override
+    current_desktop = environ.get("XDG_CURRENT_DESKTOP", "").lower()
+    if "xfce" in current_desktop:
+        return "xfwm"
+    if "gnome" in current_desktop:
+        return "mutter"
+    if current_desktop and "mate" not in current_desktop:
+        return "ewmh"
+    # This script was written for MATE, so Marco is also the default.
+    return "marco"
+
+
+def get_names_backend():
+    global names_backend
+    if names_backend is None:
+        names_backend = detect_names_backend(os.environ)
+        debug(f"names backend: {names_backend}")
+    return names_backend
+
+
+def names_backend_error():
+    """Returns why the names backend can't be used, or None if it can."""
+    if get_names_backend() != "ewmh":
+        return None
+    if import_xlib() is None:
+        return "Error: Renaming workspaces on this desktop requires python-xlib"
+    try:
+        ewmh()
+    except (OSError, Xlib.error.DisplayError) as e:
+        return f"Error: Can't connect to the X display to rename workspaces: {e}"
+    return None
 
 
 def switch(desktop):
     debug(f"switch: d {desktop}")
-    run_command(f"wmctrl -s {desktop}")
+    desktop = desktop_number(desktop)
+    if desktop is None:
+        return
+    if backend == "ewmh":
+        ewmh().switch(desktop)
+    else:
+        run_command(["wmctrl", "-s", str(desktop)])
+    expect_applied(curr=desktop)
+
+
+def set_num_desktops(num_desktops):
+    debug(f"set_num_desktops: {num_desktops}")
+    if backend == "ewmh":
+        ewmh().set_num_desktops(num_desktops)
+        return
+    run_command(["wmctrl", "-n", str(num_desktops)])
 
 
 def get_desktop_info():
@@ -157,186 +1398,1007 @@ def get_desktop_info():
 
     curr: current desktop number
     num: number of desktops
-    list: array of tuples(num, name)
+    list: array of Desktop records
     """
-    desktop_info = {}
-    desktop_info["list"] = []
-    desktops = run_command("wmctrl -d")
-    desktop_list = desktops.split("\n")
-    for desktop in desktop_list:
-        raw = desktop.split()
-        if len(raw) < 10:
-            continue
-        if raw[1] == "*":
-            desktop_info["curr"] = int(raw[0])
-        desktop_info["list"].append((raw[0], " ".join(raw[9:])))
-        debug(f"get_desktop_info: d {raw[0]} = [{' '.join(raw[9:])}]")
+    return cached_state("desktops", read_desktop_info)
+
+
+def read_desktop_info():
+    if backend == "ewmh":
+        return ewmh().get_desktop_info()
+    desktops = run_command(["wmctrl", "-d"])
+    desktop_info = {"list": []}
+    for desktop in parse_desktop_list(io.StringIO(desktops.stdout)):
+        if desktop.current:
+            desktop_info["curr"] = desktop.num
+        desktop_info["list"].append(desktop)
     desktop_info["num"] = len(desktop_info["list"])
     return desktop_info
 
 
-def insert_before(desktop):
+def position(desktops, desktop):
+    """Returns where desktop is in desktops. Desktops are compared by identity,
+    since two new desktops are equal dicts."""
+    return next(i for (i, d) in enumerate(desktops) if d is desktop)
+
+
+class LayoutModel:
+    """The desktops, their names, the current desktop and the desktop of every
+    window, held in memory so that any number of changes can be made to it and
+    then applied to the real desktop in one pass.
+
+    Each desktop is a dict with its "name" and the number it had in the
+    snapshot, "old" (None for new desktops). Desktops are tracked by identity,
+    so their windows and names move with them. The methods raise ValueError
+    with a message for the user if a change isn't possible."""
+
+    def __init__(self, desktop_info, window_index):
+        self.desktop_info = desktop_info
+        self.desktops = [
+            {"old": i, "name": d.name} for (i, d) in enumerate(desktop_info["list"])
+        ]
+        # map from win_id to the desktop dict it is on, and to its desktop
+        # number in the snapshot. Sticky windows (desktop -1) aren't tracked.
+        self.window_desktop = {}
+        self.window_old = {}
+        for desktop in sorted(window_index):
+            if desktop < 0 or desktop >= len(self.desktops):
+                continue
+            for win_info in window_index[desktop]:
+                self.window_desktop[win_info.id] = self.desktops[desktop]
+                self.window_old[win_info.id] = desktop
+        self.curr = None
+        curr = desktop_info.get("curr")
+        if curr is not None and 0 <= curr < len(self.desktops):
+            self.curr = self.desktops[curr]
+
+    def index(self, desktop, num=None):
+        """Returns desktop as an int, checking it is in range. None means the
+        current desktop."""
+        if num is None:
+            num = len(self.desktops) - 1
+        if desktop is None:
+            return position(self.desktops, self.curr)
+        desktop = int(desktop)
+        if desktop < 0 or desktop > num:
+            raise ValueError(f"Desktop number must range from 0 to {num}")
+        return desktop
+
+    def windows_on(self, desktop):
+        desktop = self.desktops[desktop]
+        return [w for w, d in self.window_desktop.items() if d is desktop]
+
+    def insert_before(self, desktop):
+        desktop = self.index(desktop, len(self.desktops))
+        self.desktops.insert(desktop, {"old": None, "name": "new-desktop"})
+
+    def delete(self, desktop):
+        desktop = self.index(desktop)
+        if self.windows_on(desktop):
+            raise ValueError("Close or move the windows first")
+        if len(self.desktops) == 1:
+            raise ValueError("Can't delete the only desktop")
+        removed = self.desktops.pop(desktop)
+        if removed is self.curr:
+            # Land on the left neighbour, or the right one if there is none.
+            self.curr = self.desktops[max(desktop - 1, 0)]
+
+    def swap(self, desktop1, desktop2, follow_curr=True):
+        desktop1 = self.index(desktop1)
+        desktop2 = self.index(desktop2)
+        curr = None
+        if self.curr is not None:
+            curr = position(self.desktops, self.curr)
+        d = self.desktops
+        d[desktop1], d[desktop2] = d[desktop2], d[desktop1]
+        if not follow_curr and curr is not None:
+            self.curr = self.desktops[curr]
+
+    def swapleft(self):
+        curr = self.index(None)
+        if curr < 1:
+            raise ValueError("Already at the far left")
+        self.swap(curr, curr - 1)
+
+    def swapright(self):
+        curr = self.index(None)
+        if curr >= len(self.desktops) - 1:
+            raise ValueError("Already at the far right")
+        self.swap(curr, curr + 1)
+
+    def move(self, desktop, new_idx):
+        desktop = self.index(desktop)
+        num = len(self.desktops)
+        new_idx = int(new_idx)
+        if new_idx < 0 or new_idx > num:
+            raise ValueError(f"The new location must range from 0 to {num}")
+        if new_idx > desktop:
+            new_idx -= 1
+        self.desktops.insert(new_idx, self.desktops.pop(desktop))
+
+    def reorder(self, order):
+        """Rearranges the desktops so that new desktop i is old desktop
+        order[i], or a new empty desktop where order[i] is None. Desktops left
+        out of order are removed."""
+        old = self.desktops
+        self.desktops = []
+        for i in order:
+            if i is None:
+                self.desktops.append({"old": None, "name": "new-desktop"})
+            else:
+                self.desktops.append(old[i])
+        kept = set(id(d) for d in self.desktops)
+        for d in self.window_desktop.values():
+            if id(d) not in kept:
+                raise ValueError("Close or move the windows first")
+        if self.curr is not None and id(self.curr) not in kept:
+            # Land on the nearest desktop to the left that is kept.
+            left = [d for d in old[: position(old, self.curr)] if id(d) in kept]
+            self.curr = left[-1] if left else self.desktops[0]
+
+    def permute(self, order):
+        """Rearranges the desktops so that new desktop i is desktop order[i].
+        order must name every desktop once."""
+        order = [self.index(desktop) for desktop in order]
+        if sorted(order) != list(range(len(self.desktops))):
+            num = len(self.desktops) - 1
+            raise ValueError(f"Please list every desktop from 0 to {num} once")
+        self.reorder(order)
+
+    def sort(self, key):
+        """Sorts the desktops by "name", or by "windows" with the most windows
+        first. Desktops that compare equal keep their order."""
+        if key == "name":
+            order = sorted(
+                range(len(self.desktops)),
+                key=lambda i: self.desktops[i]["name"].lower(),
+            )
+        elif key == "windows":
+            num_windows = collections.Counter(
+                id(d) for d in self.window_desktop.values()
+            )
+            order = sorted(
+                range(len(self.desktops)),
+                key=lambda i: -num_windows[id(self.desktops[i])],
+            )
+        else:
+            raise ValueError(f"Can't sort by {key}. Use name or windows")
+        self.reorder(order)
+
+    def compact(self):
+        """Removes every desktop without windows, keeping at least one."""
+        occupied = set(id(d) for d in self.window_desktop.values())
+        order = [i for (i, d) in enumerate(self.desktops) if id(d) in occupied]
+        if not order:
+            order = [self.index(None) if self.curr else 0]
+        self.reorder(order)
+
+    def rename(self, desktop, new_name):
+        self.desktops[self.index(desktop)]["name"] = new_name
+
+    def move_wins(self, source_desktop, dest_desktop):
+        source = self.desktops[self.index(source_desktop)]
+        dest = self.desktops[self.index(dest_desktop)]
+        for win_id, desktop in self.window_desktop.items():
+            if desktop is source:
+                self.window_desktop[win_id] = dest
+
+    def switch(self, desktop):
+        self.curr = self.desktops[self.index(desktop)]
+
+    def plan(self):
+        """Returns the plan that takes the snapshot to this layout, as a map
+        with keys:
+
+        num: final number of desktops
+        moves: array of tuples(win_id, desktop), one per window that changes desktop
+        renames: array of tuples(desktop, name), one per name that changes
+        curr: desktop to switch to at the end, or None to leave it alone
+        """
+        plan = {"num": len(self.desktops), "moves": [], "renames": [], "curr": None}
+        new_index = {id(d): i for (i, d) in enumerate(self.desktops)}
+        for win_id, desktop in self.window_desktop.items():
+            new = new_index[id(desktop)]
+            if new != self.window_old[win_id]:
+                plan["moves"].append((win_id, new))
+        old_names = [d.name for d in self.desktop_info["list"]]
+        for new, desktop in enumerate(self.desktops):
+            if new >= len(old_names) or old_names[new] != desktop["name"]:
+                plan["renames"].append((new, desktop["name"]))
+        if self.curr is not None:
+            new_curr = new_index[id(self.curr)]
+            if new_curr != self.desktop_info["curr"]:
+                plan["curr"] = new_curr
+        return plan
+
+
+def apply_plan(plan, desktop_info):
+    num_desktops = desktop_info["num"]
+    debug(
+        f"apply_plan: {num_desktops} -> {plan['num']} desktops, "
+        f"{len(plan['moves'])} moves, {len(plan['renames'])} renames"
+    )
+    if plan["renames"]:
+        # Check before changing anything, so a failure leaves no half-done
+        # layout behind.
+        error = names_backend_error()
+        if error is not None:
+            print(error)
+            return
+    if plan["num"] > num_desktops:
+        set_num_desktops(plan["num"])
+    move_windows(plan["moves"])
+    rename_many(
+        plan["renames"], names_after(desktop_info, plan["num"], plan["renames"])
+    )
+    if plan["num"] < num_desktops:
+        set_num_desktops(plan["num"])
+    if plan["curr"] is not None:
+        switch(plan["curr"])
+    expect_applied(
+        num=plan["num"], names=dict(plan["renames"]), windows=dict(plan["moves"])
+    )
+
+
+def change_layout(change, window_index=None):
+    """Takes one snapshot of the desktops, lets change(model) edit it as a
+    LayoutModel, and then applies the result in one pass. A window_index the
+    caller already has is used instead of listing the windows again.
+
+    Returns False, having printed why and changed nothing, if change raised
+    ValueError."""
     desktop_info = get_desktop_info()
-    # add another desktop
-    num_desktops = desktop_info["num"] + 1
-    run_command(f"wmctrl -n {num_desktops}")
+    if window_index is None:
+        window_index = get_window_index()
+    model = LayoutModel(desktop_info, window_index)
+    try:
+        change(model)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+    apply_plan(model.plan(), desktop_info)
+    return True
+
+
+def insert_before(desktop):
+    debug(f"insert_before: d {desktop}")
     if desktop == "none":
-        desktop = desktop_info["curr"]
-    desktop = int(desktop)
-    # shift the other desktops down to make room
-    for i in range(num_desktops - 2, int(desktop) - 1, -1):
-        move_wins(i, i + 1)
-        rename(i + 1, desktop_info["list"][i][1])
-    rename(int(desktop), "new-desktop")
-    curr = desktop_info["curr"]
-    if desktop <= curr:
-        switch(curr + 1)
+        desktop = None
+    change_layout(lambda model: model.insert_before(desktop))
 
 
 def swap(desktop1, desktop2):
     if desktop1 == "none" or desktop2 == "none":
         print("Error: Please specify 2 desktop numbers to swap")
         return
-    desktop1 = int(desktop1)
-    desktop2 = int(desktop2)
-    desktop_info = get_desktop_info()
-    num_desktops = desktop_info["num"]
-    if (
-        desktop1 < 0
-        or desktop1 >= num_desktops
-        or desktop2 < 0
-        or desktop2 >= num_desktops
-    ):
-        print(f"Error: Desktop numbers must range from 0 to {num_desktops - 1}")
-        return
     debug(f"swap {desktop1} {desktop2}")
-    # temporarily add another desktop at the end
-    run_command(f"wmctrl -n {num_desktops + 1}")
-    move_wins(desktop1, num_desktops)
-    move_wins(desktop2, desktop1)
-    move_wins(num_desktops, desktop2)
-    # remove the temporary desktop
-    run_command(f"wmctrl -n {num_desktops}")
-    rename(desktop1, desktop_info["list"][desktop2][1])
-    rename(desktop2, desktop_info["list"][desktop1][1])
+    change_layout(lambda model: model.swap(desktop1, desktop2, follow_curr=False))
 
 
 def swapleft():
     debug("swapleft")
-    desktop_info = get_desktop_info()
-    curr = desktop_info["curr"]
-    if curr < 1:
-        print(f"Error: Already at the far left")
-        return
-    swap(curr, curr - 1)
-    switch(curr - 1)
+    change_layout(lambda model: model.swapleft())
 
 
 def swapright():
     debug("swapright")
-    desktop_info = get_desktop_info()
-    curr = desktop_info["curr"]
-    num = desktop_info["num"]
-    if curr >= num - 1:
-        print(f"Error: Already at the far right")
-        return
-    swap(curr, curr + 1)
-    switch(curr + 1)
+    change_layout(lambda model: model.swapright())
 
 
 def delete(desktop):
-    desktop_info = get_desktop_info()
+    debug(f"delete: d {desktop}")
     if desktop == "none":
-        desktop = desktop_info["curr"]
-    desktop = int(desktop)
-    # TODO: are there any other windows there?
-    window_info = get_window_info(desktop)
-    if len(window_info) > 0:
-        print("Error: Close or move the windows first")
-        return
-    debug(f"delete: d {desktop} of {desktop_info['num']}")
-    for i in range(desktop, desktop_info["num"] - 1):
-        move_wins(i + 1, i)
-        rename(i, desktop_info["list"][i + 1][1])
-    num_desktops = desktop_info["num"] - 1
-    run_command(f"wmctrl -n {num_desktops}")
-    curr = desktop_info["curr"]
-    if desktop <= curr:
-        switch(curr - 1)
+        desktop = None
+    change_layout(lambda model: model.delete(desktop))
 
 
 def move(desktop, new_idx):
     if desktop == "none" or new_idx == "none":
         print("Error: Please specify the desktop to move and the new location")
         return
-    desktop = int(desktop)
-    new_idx = int(new_idx)
-    desktop_info = get_desktop_info()
-    num_desktops = desktop_info["num"]
-    if desktop < 0 or desktop >= num_desktops:
-        print(f"Error: Desktop number must range from 0 to {num_desktops - 1}")
+    debug(f"move {desktop} {new_idx}")
+    change_layout(lambda model: model.move(desktop, new_idx))
+
+
+def reorder_desktops(order):
+    if not order:
+        print("Error: Please list the desktops in their new order")
+        return
+    debug(f"reorder_desktops {order}")
+    change_layout(lambda model: model.permute(order))
+
+
+def sort_desktops(key):
+    debug(f"sort_desktops {key}")
+    change_layout(lambda model: model.sort(key))
+
+
+def sort_key(args):
+    """Returns the key of "sort --by key", which defaults to name."""
+    if args[:1] == ["--by"]:
+        if len(args) < 2:
+            raise ValueError("Missing value for --by")
+        return args[1]
+    if args:
+        raise ValueError(f"Unknown option: {args[0]}")
+    return "name"
+
+
+def compact():
+    debug("compact")
+    change_layout(lambda model: model.compact())
+
+
+def batch_operations(model, lines):
+    """Applies the operations in lines, one per line in the same form as the
+    command line, to a LayoutModel.
+
+    Blank lines and lines starting with # are skipped. Raises ValueError naming
+    the line of the first operation that can't be done."""
+    for line_num, line in enumerate(lines, 1):
+        try:
+            args = shlex.split(line, comments=True)
+            if not args:
+                continue
+            apply_batch_operation(model, args[0], args[1:])
+        except (ValueError, IndexError) as e:
+            if isinstance(e, IndexError):
+                e = "Missing argument"
+            raise ValueError(f"line {line_num}: {line.strip()}: {e}")
+
+
+def apply_batch_operation(model, op, args):
+    # Missing desktop numbers mean the current desktop, as they do on the
+    # command line.
+    desktop = args[0] if args else None
+    if op == "insert":
+        model.insert_before(desktop)
+    elif op == "delete":
+        model.delete(desktop)
+    elif op == "swap":
+        model.swap(args[0], args[1], follow_curr=False)
+    elif op == "swapleft":
+        model.swapleft()
+    elif op == "swapright":
+        model.swapright()
+    elif op == "move":
+        model.move(args[0], args[1])
+    elif op == "rename":
+        model.rename(args[0], args[1])
+    elif op == "movewins":
+        model.move_wins(args[0], args[1])
+    elif op == "switch":
+        model.switch(args[0])
+    elif op == "compact":
+        model.compact()
+    elif op == "reorder":
+        model.permute(args)
+    elif op == "sort":
+        model.sort(sort_key(args))
+    else:
+        raise ValueError(f"Unknown operation: {op}")
+
+
+def batch(path):
+    """Runs the operations in the file at path (or stdin for "none" or "-")
+    against one snapshot, then makes only the changes needed to reach the
+    final layout."""
+    if path in ["none", "-"]:
+        lines = sys.stdin.readlines()
+    else:
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except OSError as e:
+            print(f"Error: {e}")
+            return
+    debug(f"batch: {len(lines)} lines")
+    change_layout(lambda model: batch_operations(model, lines))
+
+
+def save_layout(path):
+    """Writes the workspace names and the workspace of every window to path,
+    as JSON."""
+    if not path:
+        print("Error: Please give the file to save the layout to")
         return
-    if new_idx < 0 or new_idx > num_desktops:
-        print(f"Error: The new location must range from 0 to {num_desktops}")
+    desktop_info = get_desktop_info()
+    windows = []
+    for w in get_window_info("none"):
+        if w.desktop < 0:
+            continue
+        windows.append(
+            {
+                "id": window_id(w.id),
+                "desktop": w.desktop,
+                "class": w.wm_class,
+                "title": w.title,
+            }
+        )
+    layout = {"desktops": [d.name for d in desktop_info["list"]], "windows": windows}
+    try:
+        with open(path, "w") as f:
+            json.dump(layout, f, indent=1)
+            f.write("\n")
+    except OSError as e:
+        print(f"Error: {e}")
+
+
+def match_saved_windows(saved_windows, live_windows):
+    """Returns a map from live win_id to the desktop it had in the saved
+    layout.
+
+    Windows are matched by ID. A saved window whose ID is gone, say after a
+    restart, is matched to a live window with the same class and title that
+    isn't matched yet."""
+    live_ids = set(w.id for w in live_windows)
+    matched = {}
+    unmatched = []
+    for saved in saved_windows:
+        win_id = int(saved["id"], 16)
+        if win_id in live_ids:
+            matched[win_id] = saved["desktop"]
+        else:
+            unmatched.append(saved)
+    # map from (class, title) to the live windows that haven't been matched.
+    by_class_title = {}
+    for w in live_windows:
+        if w.id not in matched:
+            by_class_title.setdefault((w.wm_class, w.title), []).append(w.id)
+    for saved in unmatched:
+        candidates = by_class_title.get((saved["class"], saved["title"]))
+        if candidates:
+            matched[candidates.pop(0)] = saved["desktop"]
+    return matched
+
+
+def check_layout(layout):
+    """Raises ValueError unless layout looks like what save_layout writes."""
+    if not isinstance(layout, dict):
+        raise ValueError("The saved layout isn't a JSON object")
+    names = layout.get("desktops")
+    if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+        raise ValueError("The saved layout needs a list of desktop names")
+    if not names:
+        raise ValueError("The saved layout has no desktops")
+    windows = layout.get("windows")
+    if not isinstance(windows, list):
+        raise ValueError("The saved layout needs a list of windows")
+    for saved in windows:
+        if (
+            not isinstance(saved, dict)
+            or not isinstance(saved.get("id"), str)
+            or not re.fullmatch(r"0x[0-9a-fA-F]+", saved["id"])
+            or not isinstance(saved.get("desktop"), int)
+            or saved["desktop"] < 0
+            or "class" not in saved
+            or not isinstance(saved["class"], (str, type(None)))
+            or not isinstance(saved.get("title"), str)
+        ):
+            raise ValueError(f"Bad window in the saved layout: {json.dumps(saved)}")
+
+
+def restore_saved_layout(model, layout, window_info):
+    """Changes model to have the saved workspace names and puts every window
+    that can be matched back on its saved workspace. Windows left on
+    workspaces that are removed end up on the new last one."""
+    names = layout["desktops"]
+    while len(model.desktops) < len(names):
+        model.desktops.append({"old": None, "name": ""})
+    for desktop, name in zip(model.desktops, names):
+        desktop["name"] = name
+    matched = match_saved_windows(layout["windows"], window_info)
+    last = len(names) - 1
+    for win_id, desktop in model.window_desktop.items():
+        if win_id in matched and matched[win_id] <= last:
+            model.window_desktop[win_id] = model.desktops[matched[win_id]]
+        elif position(model.desktops, desktop) > last:
+            model.window_desktop[win_id] = model.desktops[last]
+    if model.curr is not None and position(model.desktops, model.curr) > last:
+        model.curr = model.desktops[last]
+    del model.desktops[len(names) :]
+
+
+def restore_layout(path):
+    """Brings back a layout written by save_layout, making only the moves,
+    renames and desktop count changes needed to get there from the live
+    state."""
+    if not path:
+        print("Error: Please give the file to restore the layout from")
         return
-    if new_idx == desktop:
+    try:
+        with open(path) as f:
+            layout = json.load(f)
+        check_layout(layout)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
         return
-    debug(f"move {desktop} {new_idx}")
-    switch_to_idx = desktop_info["curr"]
-    if desktop == desktop_info["curr"] and desktop > new_idx:
-        switch_to_idx = new_idx
-    if desktop == desktop_info["curr"] and desktop < new_idx:
-        switch_to_idx = new_idx - 1
-    elif new_idx <= desktop_info["curr"] and desktop > desktop_info["curr"]:
-        switch_to_idx = desktop_info["curr"] + 1
-    elif new_idx > desktop_info["curr"] and desktop < desktop_info["curr"]:
-        switch_to_idx = desktop_info["curr"] - 1
-    insert_before(new_idx)
-    if new_idx < desktop:
-        desktop += 1
-    swap(desktop, new_idx)
-    delete(desktop)
-    debug(f"move switching from {desktop_info['curr']} to {switch_to_idx}")
-    switch(switch_to_idx)
+    window_info = get_window_info("none")
+    change_layout(
+        lambda model: restore_saved_layout(model, layout, window_info),
+        window_index=index_windows(window_info),
+    )
+
+
+# Commands that change the desktops run one at a time, holding the lock file.
+# The commands in queued_commands are written to the spool directory first,
+# and whoever gets the lock runs every queued command against one snapshot,
+# so holding down the key bound to swapleft makes one change per turn of the
+# lock instead of one per key repeat. Dialogs don't hold the lock while open.
+queued_commands = ["swapleft", "swapright"]
+unlocked_commands = ["gui_rename", "gui_switch"]
+
+
+def lock_path():
+    return runtime_path(".lock")
+
+
+def spool_path():
+    return runtime_path(".spool")
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def desktop_lock():
+    return file_lock(lock_path())
+
+
+def queue_command(argv):
+    """Adds argv to the spool directory and returns the path of its entry."""
+    spool = spool_path()
+    os.makedirs(spool, mode=0o700, exist_ok=True)
+    entry = os.path.join(spool, f"{time.time_ns():020d}-{os.getpid()}")
+    with open(entry + ".tmp", "w") as f:
+        json.dump(argv, f)
+    # Renamed into place so no one reads it half written.
+    os.replace(entry + ".tmp", entry)
+    return entry
+
+
+def take_queued_commands():
+    """Returns every queued command line, oldest first, and empties the
+    spool directory."""
+    spool = spool_path()
+    try:
+        entries = sorted(os.listdir(spool))
+    except FileNotFoundError:
+        return []
+    queued = []
+    for entry in entries:
+        if entry.endswith(".tmp"):
+            continue
+        path = os.path.join(spool, entry)
+        try:
+            with open(path) as f:
+                queued.append(json.load(f))
+            os.unlink(path)
+        except (OSError, ValueError) as e:
+            debug(f"take_queued_commands: {entry}: {e}")
+    return queued
+
+
+def fold_queued_commands(model, queued):
+    """Applies the queued command lines to a LayoutModel. A command that can't
+    be done, like a swapleft at the far left, is reported and skipped."""
+    for argv in queued:
+        try:
+            apply_batch_operation(model, argv[0], argv[1:])
+        except ValueError as e:
+            print(f"Error: {e}")
+
+
+def run_queued(argv):
+    """Queues argv and runs it together with any other queued commands, unless
+    another process already has."""
+    global wait_applied
+    entry = queue_command(argv)
+    with desktop_lock():
+        if not os.path.exists(entry):
+            debug(f"run_queued: {argv} was run by another process")
+            return
+        queued = take_queued_commands()
+        debug(f"run_queued: {queued}")
+        # The next holder of the lock must see the finished layout.
+        saved = wait_applied
+        wait_applied = True
+        try:
+            change_layout(lambda model: fold_queued_commands(model, queued))
+        finally:
+            wait_applied = saved
 
 
 def gui_rename():
     desktop_info = get_desktop_info()
     curr = desktop_info["curr"]
-    name = desktop_info["list"][curr][1]
-    name = run_command(
-        f"zenity --text='Rename Current Workspace' --entry --entry-text='{name}'"
+    name = desktop_info["list"][curr].name
+    result = run_command(
+        [
+            "zenity",
+            "--text=Rename Current Workspace",
+            "--entry",
+            f"--entry-text={name}",
+        ],
+        timeout=dialog_timeout,
     )
-    name = name.strip()
-    # TODO: What if the actual name starts with Error. Need to fix run_command.
-    if not name.startswith("Error"):
-        rename(curr, name)
+    # zenity exits with 1 when the dialog is cancelled.
+    if result.ok:
+        rename(curr, result.stdout.strip())
+
+
+# "tk" shows the built-in picker when tkinter and a display are available and
+# falls back to zenity otherwise. "zenity" always uses zenity.
+picker = "tk"
 
 
 def gui_switch():
+    if picker == "tk":
+        try:
+            desktop = tk_pick_workspace()
+        except (ImportError, RuntimeError) as e:
+            debug(f"gui_switch: falling back to zenity: {e}")
+        else:
+            if desktop is not None:
+                switch(desktop)
+            return
+    zenity_switch()
+
+
+def zenity_switch():
     desktop_info = get_desktop_info()
-    num_desktops = desktop_info["num"]
     curr = desktop_info["curr"]
-    cmd = "zenity --list --column=num --column=Curr --column='Desktop Name' --hide-column=1 --height=540 --width=300"
-    stdin = ""
-    for i in range(num_desktops):
-        stdin += f"{i}\n"
-        if curr == i:
-            stdin += ">>>>\n"
-        else:
-            stdin += ".\n"
-        stdin += desktop_info["list"][i][1] + "\n"
-    result = run_command(cmd, stdin)
-    result = result.strip()
-    if not result.startswith("Error"):
-        switch(result)
+    argv = [
+        "zenity",
+        "--list",
+        "--column=num",
+        "--column=Curr",
+        "--column=Desktop Name",
+        "--hide-column=1",
+        "--height=540",
+        "--width=300",
+    ]
+    rows = []
+    for i in range(desktop_info["num"]):
+        rows.append(str(i))
+        rows.append(">>>>" if curr == i else ".")
+        rows.append(desktop_info["list"][i].name)
+    result = run_command(argv, "".join(row + "\n" for row in rows), dialog_timeout)
+    # zenity answers nothing if OK is pressed with no row selected.
+    if result.ok and result.stdout.strip():
+        switch(result.stdout.strip())
+
+
+def filter_workspaces(query, desktop_info, window_index):
+    """Returns the rows of the picker that match query, as an array of
+    tuples(desktop, label).
+
+    A workspace matches if every word of query appears in its name or in the
+    title of one of its windows, ignoring case. Workspaces whose name matches
+    come first."""
+    terms = query.lower().split()
+    by_name = []
+    by_window = []
+    for d in desktop_info["list"]:
+        desktop = d.num
+        name = d.name
+        curr = ">>>>" if desktop == desktop_info["curr"] else "    "
+        label = f"{curr} {desktop:>3}  {name}"
+        if all(term in name.lower() for term in terms):
+            by_name.append((desktop, label))
+            continue
+        titles = [w.title for w in window_index.get(desktop, [])]
+        text = " ".join([name] + titles).lower()
+        if not all(term in text for term in terms):
+            continue
+        matches = [t for t in titles if any(term in t.lower() for term in terms)]
+        by_window.append((desktop, f"{label}  ({matches[0]})"))
+    return by_name + by_window
+
+
+def load_picker_data():
+    """Returns what filter_workspaces needs, from one listing of the desktops
+    and one of the windows."""
+    return get_desktop_info(), get_window_index()
+
+
+def tk_pick_workspace():
+    """Shows the built-in picker and returns the chosen desktop number, or
+    None if the user cancelled.
+
+    The window opens straight away and the workspaces are filled in when the
+    listing finishes. Typing filters them with filter_workspaces. Raises
+    ImportError or RuntimeError if Tk can't be used."""
+    import queue
+    import tkinter
+
+    try:
+        root = tkinter.Tk()
+    except tkinter.TclError as e:
+        raise RuntimeError(str(e))
+    root.title("Switch Workspace")
+    query = tkinter.StringVar()
+    entry = tkinter.Entry(root, textvariable=query)
+    entry.pack(fill="x")
+    listbox = tkinter.Listbox(root, height=24, width=60, font="TkFixedFont")
+    listbox.pack(fill="both", expand=True)
+    listbox.insert("end", "Loading...")
+    entry.focus_set()
+    state = {"data": None, "rows": [], "choice": None, "error": None}
+    loaded = queue.Queue()
+
+    def load():
+        try:
+            loaded.put(load_picker_data())
+        except Exception as e:
+            loaded.put(e)
+
+    def refresh(*args):
+        if state["data"] is None:
+            return
+        state["rows"] = filter_workspaces(query.get(), *state["data"])
+        listbox.delete(0, "end")
+        for desktop, label in state["rows"]:
+            listbox.insert("end", label)
+        if state["rows"]:
+            listbox.selection_set(0)
+
+    def poll():
+        # Tk may only be used from this thread, so the listing is handed over
+        # through a queue.
+        try:
+            data = loaded.get_nowait()
+        except queue.Empty:
+            root.after(10, poll)
+            return
+        if isinstance(data, Exception):
+            state["error"] = data
+            root.destroy()
+            return
+        state["data"] = data
+        refresh()
+
+    def step(delta):
+        if not state["rows"]:
+            return
+        selected = listbox.curselection()
+        index = selected[0] + delta if selected else 0
+        index = max(0, min(index, len(state["rows"]) - 1))
+        listbox.selection_clear(0, "end")
+        listbox.selection_set(index)
+        listbox.see(index)
+
+    def choose(event=None):
+        if not state["rows"]:
+            return
+        selected = listbox.curselection()
+        state["choice"] = state["rows"][selected[0] if selected else 0][0]
+        root.destroy()
+
+    query.trace_add("write", refresh)
+    root.bind("<Return>", choose)
+    root.bind("<Escape>", lambda event: root.destroy())
+    root.bind("<Down>", lambda event: step(1))
+    root.bind("<Up>", lambda event: step(-1))
+    listbox.bind("<Double-Button-1>", choose)
+    threading.Thread(target=load, daemon=True).start()
+    root.after(10, poll)
+    root.mainloop()
+    if state["error"] is not None:
+        print(f"Error: {state['error']}")
+    return state["choice"]
+
+
+def runtime_path(suffix):
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+    display = os.environ.get("DISPLAY", "").replace("/", "_")
+    name = f"workspace_switcher-{os.getuid()}{display}{suffix}"
+    return os.path.join(runtime_dir, name)
+
+
+def daemon_socket_path():
+    return runtime_path(".sock")
+
+
+def read_json_line(sock):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data)
+
+
+def forward_to_daemon(argv, stdin=None):
+    """Runs argv in the daemon, from our working directory and with stdin as
+    its standard input, and prints its output.
+
+    Returns False if no daemon is running, so the caller can run the command
+    itself."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(daemon_socket_path())
+    except OSError:
+        client.close()
+        return False
+    with client:
+        client.settimeout(dialog_timeout + command_timeout)
+        request = {"argv": argv, "cwd": os.getcwd(), "stdin": stdin}
+        client.sendall((json.dumps(request) + "\n").encode())
+        try:
+            response = read_json_line(client)
+        except (OSError, ValueError) as e:
+            print(f"Error: No answer from the workspace daemon: {e}")
+            return True
+    sys.stdout.write(response["stdout"])
+    return True
+
+
+# Commands that don't change anything, so the daemon can keep its listings.
+read_only_commands = ["help", "list", "listwin", "find", "save"]
+# Dialogs run in the client, since the daemon answers one command at a time
+# and an open dialog would hold up every other keybinding until it closed.
+unforwarded_commands = ["gui_switch", "gui_rename"]
+
+
+def run_in_daemon(argv, cwd=None, stdin=None):
+    """Runs a forwarded command line and returns what it printed."""
+    global debugging, backend, wait_applied, fresh
+    old_cwd = os.getcwd()
+    if cwd is not None:
+        try:
+            os.chdir(cwd)
+        except OSError as e:
+            return f"Error: Can't run in {cwd}: {e}\n"
+    saved = (sys.argv, sys.stdin, debugging, backend, wait_applied, fresh)
+    sys.argv = ["workspace.py"] + list(argv)
+    sys.stdin = io.StringIO(stdin or "")
+    output = io.StringIO()
+    command = argv_or(1, "help")
+    try:
+        with contextlib.redirect_stdout(output):
+            if fresh:
+                invalidate_state_cache()
+            try:
+                dispatch(command)
+            except Exception:
+                print(f"Error: {command} failed")
+                print(traceback.format_exc())
+            finally:
+                finish_tracing()
+    finally:
+        if command not in read_only_commands:
+            invalidate_state_cache()
+            invalidate_state_file()
+        sys.argv, sys.stdin, debugging, backend, wait_applied, fresh = saved
+        os.chdir(old_cwd)
+    return output.getvalue()
+
+
+def open_daemon_socket(path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+    return server
+
+
+def serve_daemon(server, max_requests=None):
+    """Answers forwarded commands one at a time, so they never interleave."""
+    handled = 0
+    while max_requests is None or handled < max_requests:
+        conn, _ = server.accept()
+        with conn:
+            try:
+                request = read_json_line(conn)
+                stdout = run_in_daemon(
+                    request["argv"], request.get("cwd"), request.get("stdin")
+                )
+                conn.sendall((json.dumps({"stdout": stdout}) + "\n").encode())
+            except (OSError, ValueError, KeyError) as e:
+                print(f"Error: Bad request to the workspace daemon: {e}")
+        handled += 1
+
+
+def watch_for_changes():
+    """Empties the state cache every time X reports a change. Runs until X
+    can't be watched any more, and then turns the cache off, since nothing
+    would tell it that the listings went stale."""
+    global state_cache, state_cache_generation
+    try:
+        connection = EwmhConnection()
+        connection.watch_changes()
+        while True:
+            connection.next_change()
+            invalidate_state_cache()
+    except Exception as e:
+        print(f"Error: Can't watch X for changes, so listings aren't kept: {e}")
+        with state_cache_lock:
+            state_cache_generation += 1
+            state_cache = None
+
+
+def run_daemon():
+    global state_cache
+    path = daemon_socket_path()
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with probe:
+        if probe.connect_ex(path) == 0:
+            print(f"Error: The workspace daemon is already running on {path}")
+            return
+    server = open_daemon_socket(path)
+    if os.environ.get("DISPLAY") and import_xlib() is not None:
+        # Listings can only be kept between commands if X tells us when they
+        # go stale.
+        state_cache = {}
+        threading.Thread(target=watch_for_changes, daemon=True).start()
+    print(f"workspace daemon listening on {path}")
+    # Exit through the finally below so the socket is removed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve_daemon(server)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
 
 
 def main():
+    global state_cache
     command = argv_or(1, "help")
+    if command == "daemon":
+        run_daemon()
+        return
+    if command == "watch":
+        # Never forwarded, since it would keep the daemon busy for good.
+        watch(argv_or(2, "none"))
+        return
+    stdin = None
+    if command == "batch" and argv_or(2, "none") in ["none", "-"]:
+        stdin = sys.stdin.read()
+    if command not in unforwarded_commands and forward_to_daemon(sys.argv[1:], stdin):
+        return
+    if stdin is not None:
+        sys.stdin = io.StringIO(stdin)
+    run = None
+    if command in state_file_commands and not fresh:
+        run = load_state_file()
+    try:
+        if command in queued_commands:
+            run_queued(sys.argv[sys.argv.index(command) :])
+        elif command in read_only_commands or command in unlocked_commands:
+            dispatch(command)
+        else:
+            with desktop_lock():
+                dispatch(command)
+    finally:
+        finish_tracing()
+        if command not in read_only_commands:
+            invalidate_state_file()
+    if run is not None:
+        if command in read_only_commands:
+            save_state_file(run)
+        state_cache = None
+
+
+def dispatch(command):
     if command == "help":
         help()
         return
+    if command == "movewins" and argv_or(2, "none").startswith("--"):
+        move_matching_windows(argv_from(2))
+        return
     if command == "movewins":
         source_desktop = argv_or(2, "none")
         dest_desktop = argv_or(3, "none")
@@ -349,6 +2411,14 @@ def main():
         desktop = argv_or(2, "none")
         list_windows(desktop)
         return
+    if command == "find":
+        query = argv_or(2, "")
+        find_windows(query)
+        return
+    if command == "goto":
+        query = argv_or(2, "")
+        goto(query)
+        return
     if command == "rename":
         desktop = argv_or(2, "none")
         new_name = argv_or(3, "none")
@@ -382,6 +2452,32 @@ def main():
         new_idx = argv_or(3, "none")
         move(desktop, new_idx)
         return
+    if command == "compact":
+        compact()
+        return
+    if command == "reorder":
+        reorder_desktops(argv_from(2))
+        return
+    if command == "sort":
+        try:
+            key = sort_key(argv_from(2))
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        sort_desktops(key)
+        return
+    if command == "batch":
+        path = argv_or(2, "none")
+        batch(path)
+        return
+    if command == "save":
+        path = argv_or(2, "")
+        save_layout(path)
+        return
+    if command == "restore":
+        path = argv_or(2, "")
+        restore_layout(path)
+        return
     if command == "gui_rename":
         gui_rename()
         return